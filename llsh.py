@@ -3,20 +3,15 @@
 
 import re
 import lldb
-import rust_demangler
 from contextlib import redirect_stdout
+from rsprof.symbolutil import target_symbol_indexes
 
 
 def symbols(target: lldb.SBTarget):
-    for i in range(0, target.GetNumModules()):
-        module: lldb.SBModule = target.GetModuleAtIndex(i)
-        for si in range(0, module.GetNumSymbols()):
-            symbol: lldb.SBSymbol = module.GetSymbolAtIndex(si)
-            yield symbol
-
-
-def not_none_str(a):
-    return "" if a is None else a
+    # (name, mangled name) of every symbol, read from the persistent symbol
+    # index of each module
+    for _, index in target_symbol_indexes(target):
+        yield from zip(index.names, index.mangled_names)
 
 
 @lldb.command("list-names", "list all symbols' name of the current target")
@@ -24,8 +19,8 @@ def list_symbols(debugger: lldb.SBDebugger, command: str, result, options):
     with redirect_stdout(result):
         target: lldb.SBTarget = debugger.GetSelectedTarget()
         if target.IsValid():
-            for symbol in symbols(target):
-                print(not_none_str(symbol.GetName()))
+            for name, _ in symbols(target):
+                print(name)
 
 
 @lldb.command("list-sysnames", "list all symbols' mangled name of the current target")
@@ -33,8 +28,8 @@ def list_symbols(debugger: lldb.SBDebugger, command: str, result, options):
     with redirect_stdout(result):
         target: lldb.SBTarget = debugger.GetSelectedTarget()
         if target.IsValid():
-            for symbol in symbols(target):
-                print(not_none_str(symbol.GetMangledName()))
+            for _, mangled_name in symbols(target):
+                print(mangled_name)
 
 
 @lldb.command("find-names", "find name with regex")
@@ -43,8 +38,7 @@ def find_names(debugger: lldb.SBDebugger, command: str, result, options):
         target: lldb.SBTarget = debugger.GetSelectedTarget()
         if target.IsValid():
             pattern = re.compile(command)
-            for symbol in symbols(target):
-                sym_name = not_none_str(symbol.GetName())
+            for sym_name, _ in symbols(target):
                 if pattern.match(sym_name) is not None:
                     print(sym_name)
 
@@ -55,8 +49,7 @@ def find_sysnames(debugger: lldb.SBDebugger, command: str, result, options):
         target: lldb.SBTarget = debugger.GetSelectedTarget()
         if target.IsValid():
             pattern = re.compile(command)
-            for symbol in symbols(target):
-                sym_name = not_none_str(symbol.GetMangledName())
+            for _, sym_name in symbols(target):
                 if pattern.match(sym_name) is not None:
                     print(sym_name)
 
@@ -67,8 +60,7 @@ def find_demangle(debugger: lldb.SBDebugger, command: str, result, options):
         target: lldb.SBTarget = debugger.GetSelectedTarget()
         if target.IsValid():
             pattern = re.compile(command)
-            for symbol in symbols(target):
-                sym_name = rust_demangler.demangle(
-                    not_none_str(symbol.GetMangledName()))
-                if pattern.match(sym_name) is not None:
-                    print(sym_name)
+            for _, index in target_symbol_indexes(target):
+                for sym_name in index.demangled():
+                    if pattern.match(sym_name) is not None:
+                        print(sym_name)
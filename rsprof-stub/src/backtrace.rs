@@ -0,0 +1,49 @@
+// bounded backtrace by walking the frame pointer chain, it requires the
+// program (and std, through -Zbuild-std or a nightly toolchain) to be built
+// with `-C force-frame-pointers=yes`
+pub const MAX_DEPTH: usize = 32;
+
+// frames are never larger than this, anything else is not a frame pointer
+const MAX_FRAME_SIZE: usize = 1 << 24;
+
+#[inline(always)]
+fn frame_pointer() -> usize {
+    let fp: usize;
+    #[cfg(target_arch = "x86_64")]
+    unsafe {
+        core::arch::asm!("mov {}, rbp", out(reg) fp, options(nomem, nostack, preserves_flags));
+    }
+    #[cfg(target_arch = "aarch64")]
+    unsafe {
+        core::arch::asm!("mov {}, x29", out(reg) fp, options(nomem, nostack, preserves_flags));
+    }
+    #[cfg(not(any(target_arch = "x86_64", target_arch = "aarch64")))]
+    {
+        fp = 0;
+    }
+    return fp;
+}
+
+// return addresses of the callers, innermost first
+#[inline(always)]
+pub fn capture(pcs: &mut [u64; MAX_DEPTH]) -> usize {
+    let mut fp = frame_pointer();
+    let mut depth = 0;
+    while depth < MAX_DEPTH && fp != 0 && fp % std::mem::align_of::<usize>() == 0 {
+        // a frame record is the caller's frame pointer and the return address
+        let frame = fp as *const usize;
+        let (next, pc) = unsafe { (*frame, *frame.add(1)) };
+        if pc == 0 {
+            break;
+        }
+        pcs[depth] = pc as u64;
+        depth += 1;
+
+        // the stack grows down, so callers' frames are at higher addresses
+        if next <= fp || next - fp > MAX_FRAME_SIZE {
+            break;
+        }
+        fp = next;
+    }
+    return depth;
+}
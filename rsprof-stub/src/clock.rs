@@ -0,0 +1,29 @@
+// timestamps taken in process, on the clock of the timestamps the debugger
+// takes itself so that both kinds of events are ordered together
+use std::os::raw::{c_int, c_long};
+
+#[repr(C)]
+struct Timespec {
+    tv_sec: c_long,
+    tv_nsec: c_long,
+}
+
+// the clock of time.monotonic_ns() in python: CLOCK_MONOTONIC on linux and
+// CLOCK_UPTIME_RAW, the clock of mach_absolute_time, on macos
+#[cfg(target_os = "macos")]
+const MONOTONIC_CLOCK: c_int = 8;
+#[cfg(not(target_os = "macos"))]
+const MONOTONIC_CLOCK: c_int = 1;
+
+extern "C" {
+    fn clock_gettime(clock: c_int, time: *mut Timespec) -> c_int;
+}
+
+pub fn monotonic_ns() -> u64 {
+    let mut time = Timespec {
+        tv_sec: 0,
+        tv_nsec: 0,
+    };
+    unsafe { clock_gettime(MONOTONIC_CLOCK, &mut time) };
+    time.tv_sec as u64 * 1_000_000_000 + time.tv_nsec as u64
+}
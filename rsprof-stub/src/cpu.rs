@@ -0,0 +1,35 @@
+// sampler thread of the cpu module: it calls the hook at the frequency the
+// debugger puts in RSPROF_CPU_HZ, the process is stopped there and the
+// debugger samples the call stacks of all of the other threads
+use std::sync::Once;
+use std::thread;
+use std::time::Duration;
+
+pub const CPU_HZ_VAR: &str = "RSPROF_CPU_HZ";
+
+// debugger would hook on this function to sample threads
+#[inline(never)]
+#[no_mangle]
+pub extern "C" fn __rsprof_cpu_sample() {
+    std::hint::black_box(());
+}
+
+static START: Once = Once::new();
+
+// start the sampler once, it is not started unless the cpu module is enabled
+// before the program is launched, or RSPROF_CPU_HZ is set by hand
+pub fn start_cpu_sampler() {
+    START.call_once(|| {
+        let hz = match std::env::var(CPU_HZ_VAR).map(|value| value.parse::<u64>()) {
+            Ok(Ok(hz)) if hz > 0 => hz,
+            _ => return,
+        };
+        let interval = Duration::from_nanos(1_000_000_000 / hz);
+        let _ = thread::Builder::new()
+            .name("rsprof-cpu".into())
+            .spawn(move || loop {
+                thread::sleep(interval);
+                __rsprof_cpu_sample();
+            });
+    });
+}
@@ -1,5 +1,18 @@
 use std::alloc::GlobalAlloc;
 
+#[cfg(feature = "backtrace")]
+mod backtrace;
+#[cfg(feature = "ring-buffer")]
+mod ring;
+mod clock;
+mod cpu;
+mod mutex;
+mod sampling;
+
+pub use cpu::{start_cpu_sampler, CPU_HZ_VAR};
+pub use mutex::{RsprofMutex, RsprofMutexGuard, MUTEX_ACQUIRE, MUTEX_ATTEMPT, MUTEX_RELEASE};
+pub use sampling::SAMPLE_VAR;
+
 pub struct RsprofAllocator<T>
 where
     T: GlobalAlloc,
@@ -20,6 +33,55 @@ pub extern "C" fn __rsprof_memtrace_event(
     return ptr;
 }
 
+// with the "ring-buffer" feature events are buffered per thread and only
+// reported through the hook when a thread could not get a buffer, with the
+// "backtrace" feature the call stack is captured in process
+#[inline(always)]
+fn memtrace_event(event: usize, size: usize, align: usize, ptr: *mut u8) -> *mut u8 {
+    // events skipped by RSPROF_SAMPLE are not reported at all
+    if !sampling::keep(event, size, ptr) {
+        return ptr;
+    }
+
+    #[cfg(feature = "backtrace")]
+    {
+        let mut pcs = [0u64; backtrace::MAX_DEPTH];
+        let depth = backtrace::capture(&mut pcs);
+
+        #[cfg(feature = "ring-buffer")]
+        if ring::record(event, size, align, ptr, &pcs[..depth]) {
+            return ptr;
+        }
+        return __rsprof_memtrace_backtrace_event(event, size, align, ptr, pcs.as_ptr(), depth);
+    }
+
+    #[cfg(not(feature = "backtrace"))]
+    {
+        #[cfg(feature = "ring-buffer")]
+        if ring::record(event, size, align, ptr, &[]) {
+            return ptr;
+        }
+        return __rsprof_memtrace_event(event, size, align, ptr);
+    }
+}
+
+// the "backtrace" feature hooks on this function instead, with the return
+// addresses of the allocation's call stack
+#[inline(never)]
+#[allow(unused_variables)]
+#[no_mangle]
+pub extern "C" fn __rsprof_memtrace_backtrace_event(
+    event: usize,
+    size: usize,
+    align: usize,
+    ptr: *mut u8,
+    pcs: *const u64,
+    depth: usize,
+) -> *mut u8 {
+    std::hint::black_box((pcs, depth));
+    return ptr;
+}
+
 unsafe impl<T> Sync for RsprofAllocator<T> where T: GlobalAlloc {}
 
 unsafe impl<T> GlobalAlloc for RsprofAllocator<T>
@@ -27,7 +89,7 @@ where
     T: GlobalAlloc,
 {
     unsafe fn alloc(&self, layout: std::alloc::Layout) -> *mut u8 {
-        return __rsprof_memtrace_event(
+        return memtrace_event(
             0,
             layout.size(),
             layout.align(),
@@ -37,7 +99,7 @@ where
 
     unsafe fn dealloc(&self, ptr: *mut u8, layout: std::alloc::Layout) {
         self.allocator.dealloc(
-            __rsprof_memtrace_event(1, layout.size(), layout.align(), ptr),
+            memtrace_event(1, layout.size(), layout.align(), ptr),
             layout,
         )
     }
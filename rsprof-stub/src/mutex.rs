@@ -0,0 +1,138 @@
+// std::sync::Mutex reporting its lock events through a dedicated hook, so
+// that the mutex module traces it in optimized builds too, where the generic
+// functions of std are inlined and could not be hooked
+use std::fmt;
+use std::mem::ManuallyDrop;
+use std::ops::{Deref, DerefMut};
+use std::sync::{LockResult, Mutex, MutexGuard, PoisonError, TryLockError, TryLockResult};
+
+use crate::clock::monotonic_ns;
+
+// events of the hook, the debugger maps them to its own lock events
+pub const MUTEX_ATTEMPT: usize = 0;
+pub const MUTEX_ACQUIRE: usize = 1;
+pub const MUTEX_RELEASE: usize = 2;
+
+// debugger would hook on this function to trace lock events, the timestamps
+// are taken in process so that the stops of the hook are not measured: the
+// event happened at timestamp and an acquisition started waiting at since
+#[inline(never)]
+#[allow(unused_variables)]
+#[no_mangle]
+pub extern "C" fn __rsprof_mutex_event(event: usize, mutex: *const u8, timestamp: u64, since: u64) {
+    std::hint::black_box((event, mutex, timestamp, since));
+}
+
+// transparent, so that the mutex has the same address as the std::sync::Mutex
+// it wraps, whose hooks may report the same events in unoptimized builds
+#[repr(transparent)]
+pub struct RsprofMutex<T: ?Sized> {
+    inner: Mutex<T>,
+}
+
+pub struct RsprofMutexGuard<'a, T: ?Sized> {
+    mutex: &'a RsprofMutex<T>,
+    guard: ManuallyDrop<MutexGuard<'a, T>>,
+}
+
+impl<T> RsprofMutex<T> {
+    pub const fn new(value: T) -> Self {
+        RsprofMutex {
+            inner: Mutex::new(value),
+        }
+    }
+
+    pub fn into_inner(self) -> LockResult<T> {
+        self.inner.into_inner()
+    }
+}
+
+impl<T: ?Sized> RsprofMutex<T> {
+    fn address(&self) -> *const u8 {
+        self as *const Self as *const u8
+    }
+
+    fn guard<'a>(&'a self, guard: MutexGuard<'a, T>, since: u64) -> RsprofMutexGuard<'a, T> {
+        __rsprof_mutex_event(MUTEX_ACQUIRE, self.address(), monotonic_ns(), since);
+        RsprofMutexGuard {
+            mutex: self,
+            guard: ManuallyDrop::new(guard),
+        }
+    }
+
+    pub fn lock(&self) -> LockResult<RsprofMutexGuard<'_, T>> {
+        __rsprof_mutex_event(MUTEX_ATTEMPT, self.address(), monotonic_ns(), 0);
+        // waiting starts once the debugger let the attempt go
+        let since = monotonic_ns();
+        match self.inner.lock() {
+            Ok(guard) => Ok(self.guard(guard, since)),
+            Err(poisoned) => Err(PoisonError::new(self.guard(poisoned.into_inner(), since))),
+        }
+    }
+
+    // a failed try is not an attempt, the thread never waits for the mutex
+    pub fn try_lock(&self) -> TryLockResult<RsprofMutexGuard<'_, T>> {
+        let since = monotonic_ns();
+        match self.inner.try_lock() {
+            Ok(guard) => Ok(self.guard(guard, since)),
+            Err(TryLockError::Poisoned(poisoned)) => Err(TryLockError::Poisoned(
+                PoisonError::new(self.guard(poisoned.into_inner(), since)),
+            )),
+            Err(TryLockError::WouldBlock) => Err(TryLockError::WouldBlock),
+        }
+    }
+
+    pub fn is_poisoned(&self) -> bool {
+        self.inner.is_poisoned()
+    }
+
+    pub fn get_mut(&mut self) -> LockResult<&mut T> {
+        self.inner.get_mut()
+    }
+}
+
+impl<T: Default> Default for RsprofMutex<T> {
+    fn default() -> Self {
+        RsprofMutex::new(T::default())
+    }
+}
+
+impl<T: ?Sized + fmt::Debug> fmt::Debug for RsprofMutex<T> {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        self.inner.fmt(f)
+    }
+}
+
+impl<T: ?Sized> Deref for RsprofMutexGuard<'_, T> {
+    type Target = T;
+
+    fn deref(&self) -> &T {
+        &self.guard
+    }
+}
+
+impl<T: ?Sized> DerefMut for RsprofMutexGuard<'_, T> {
+    fn deref_mut(&mut self) -> &mut T {
+        &mut self.guard
+    }
+}
+
+impl<T: ?Sized + fmt::Debug> fmt::Debug for RsprofMutexGuard<'_, T> {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        (**self).fmt(f)
+    }
+}
+
+impl<T: ?Sized + fmt::Display> fmt::Display for RsprofMutexGuard<'_, T> {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        (**self).fmt(f)
+    }
+}
+
+impl<T: ?Sized> Drop for RsprofMutexGuard<'_, T> {
+    fn drop(&mut self) {
+        // released once the mutex is unlocked, not when the guard starts dropping
+        unsafe { ManuallyDrop::drop(&mut self.guard) };
+        __rsprof_mutex_event(MUTEX_RELEASE, self.mutex.address(), monotonic_ns(), 0);
+    }
+}
@@ -0,0 +1,178 @@
+// per-thread ring buffers of memtrace events, the debugger is only involved
+// when a buffer fills up (or at exit) and reads the whole buffer at once
+use std::cell::{Cell, UnsafeCell};
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+#[cfg(feature = "backtrace")]
+use crate::backtrace::MAX_DEPTH;
+use crate::clock::monotonic_ns;
+
+// records carry a backtrace in "backtrace" mode, keep the rings small then
+#[cfg(not(feature = "backtrace"))]
+pub const RING_CAPACITY: usize = 1024;
+#[cfg(feature = "backtrace")]
+pub const RING_CAPACITY: usize = 256;
+pub const MAX_RINGS: usize = 256;
+
+const UNCLAIMED: usize = usize::MAX;
+const NO_RING: usize = usize::MAX - 1;
+
+#[repr(C)]
+#[derive(Clone, Copy)]
+pub struct Record {
+    pub event: u64,
+    pub size: u64,
+    pub align: u64,
+    pub ptr: u64,
+    // index of the ring, i.e. of the thread in the order of first allocation
+    pub thread: u64,
+    // nanoseconds of the monotonic clock, the one of the timestamps the
+    // debugger takes for events reported through the hooks
+    pub timestamp: u64,
+    #[cfg(feature = "backtrace")]
+    pub depth: u64,
+    #[cfg(feature = "backtrace")]
+    pub pcs: [u64; MAX_DEPTH],
+}
+
+const EMPTY_RECORD: Record = Record {
+    event: 0,
+    size: 0,
+    align: 0,
+    ptr: 0,
+    thread: 0,
+    timestamp: 0,
+    #[cfg(feature = "backtrace")]
+    depth: 0,
+    #[cfg(feature = "backtrace")]
+    pcs: [0; MAX_DEPTH],
+};
+
+#[repr(C)]
+pub struct Ring {
+    len: AtomicUsize,
+    records: UnsafeCell<[Record; RING_CAPACITY]>,
+}
+
+// every ring has a single producer, the thread owning it
+unsafe impl Sync for Ring {}
+
+const EMPTY_RING: Ring = Ring {
+    len: AtomicUsize::new(0),
+    records: UnsafeCell::new([EMPTY_RECORD; RING_CAPACITY]),
+};
+
+// rings live in static memory so they outlive their threads, and are found
+// by the debugger by name when it drains them on a stop
+#[no_mangle]
+pub static __rsprof_memtrace_rings: [Ring; MAX_RINGS] = [EMPTY_RING; MAX_RINGS];
+
+#[no_mangle]
+pub static __rsprof_memtrace_ring_count: AtomicUsize = AtomicUsize::new(0);
+
+#[no_mangle]
+pub static __rsprof_memtrace_ring_capacity: usize = RING_CAPACITY;
+
+#[no_mangle]
+pub static __rsprof_memtrace_record_size: usize = std::mem::size_of::<Record>();
+
+thread_local! {
+    // const initialized and without destructor, so it never allocates
+    static RING_INDEX: Cell<usize> = const { Cell::new(UNCLAIMED) };
+}
+
+extern "C" {
+    fn atexit(callback: extern "C" fn()) -> i32;
+}
+
+// debugger would hook on this function to read a full buffer of records
+#[inline(never)]
+#[no_mangle]
+pub extern "C" fn __rsprof_memtrace_flush(
+    records: *const Record,
+    count: usize,
+    record_size: usize,
+) -> usize {
+    std::hint::black_box((records, record_size));
+    return count;
+}
+
+extern "C" fn flush_all() {
+    let claimed = __rsprof_memtrace_ring_count
+        .load(Ordering::Acquire)
+        .min(MAX_RINGS);
+    for ring in &__rsprof_memtrace_rings[..claimed] {
+        flush(ring);
+    }
+}
+
+fn flush(ring: &Ring) {
+    let len = ring.len.load(Ordering::Acquire);
+    if len != 0 {
+        __rsprof_memtrace_flush(
+            ring.records.get() as *const Record,
+            len,
+            std::mem::size_of::<Record>(),
+        );
+        ring.len.store(0, Ordering::Release);
+    }
+}
+
+fn claim() -> usize {
+    let index = __rsprof_memtrace_ring_count.fetch_add(1, Ordering::AcqRel);
+    if index == 0 {
+        unsafe {
+            atexit(flush_all);
+        }
+    }
+    if index < MAX_RINGS {
+        index
+    } else {
+        NO_RING
+    }
+}
+
+fn ring_index() -> usize {
+    RING_INDEX
+        .try_with(|cell| {
+            if cell.get() == UNCLAIMED {
+                cell.set(claim());
+            }
+            cell.get()
+        })
+        .unwrap_or(NO_RING)
+}
+
+// returns false if the thread has no ring and the event must be reported
+// through the per-event hook instead
+#[allow(unused_variables)]
+pub fn record(event: usize, size: usize, align: usize, ptr: *mut u8, backtrace: &[u64]) -> bool {
+    let index = ring_index();
+    if index == NO_RING {
+        return false;
+    }
+
+    let ring = &__rsprof_memtrace_rings[index];
+    let len = ring.len.load(Ordering::Relaxed);
+    unsafe {
+        let record = &mut (*ring.records.get())[len];
+        record.event = event as u64;
+        record.size = size as u64;
+        record.align = align as u64;
+        record.ptr = ptr as u64;
+        record.thread = index as u64;
+        record.timestamp = monotonic_ns();
+        #[cfg(feature = "backtrace")]
+        {
+            record.depth = backtrace.len() as u64;
+            record.pcs[..backtrace.len()].copy_from_slice(backtrace);
+        }
+    }
+    // publish the record, readers only read the records below len
+    ring.len.store(len + 1, Ordering::Release);
+
+    if len + 1 == RING_CAPACITY {
+        flush(ring);
+    }
+    return true;
+}
@@ -0,0 +1,167 @@
+// sampling of memtrace events in process, so that skipped events never stop
+// the program: RSPROF_SAMPLE is "1/N" for one allocation in N on average, or
+// a size in bytes ("524288" or "524288B") for one sample per that many bytes
+// allocated on average, the deallocation of a sampled block is always kept
+// and the one of any other block is skipped
+use std::cell::Cell;
+use std::ffi::CStr;
+use std::os::raw::c_char;
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::time::{SystemTime, UNIX_EPOCH};
+
+extern "C" {
+    // std::env::var allocates, which the allocator could not do
+    fn getenv(name: *const c_char) -> *const c_char;
+}
+
+pub const SAMPLE_VAR: &str = "RSPROF_SAMPLE";
+
+const UNKNOWN: u64 = u64::MAX;
+// period of the sampling, 0 if every event is kept
+static PERIOD: AtomicU64 = AtomicU64::new(UNKNOWN);
+static BY_BYTES: AtomicBool = AtomicBool::new(false);
+
+// addresses of the sampled blocks still allocated, in an open addressed table
+// probed over a fixed window so that a slot is simply emptied on removal
+const TABLE_SIZE: usize = 1 << 16;
+const PROBES: usize = 16;
+const EMPTY_SLOT: AtomicUsize = AtomicUsize::new(0);
+static SAMPLED: [AtomicUsize; TABLE_SIZE] = [EMPTY_SLOT; TABLE_SIZE];
+
+thread_local! {
+    // const initialized and without destructor, so it never allocates
+    static RANDOM: Cell<u64> = const { Cell::new(0) };
+    // units (events or bytes) left before the next sample, 0 if not drawn
+    static REMAINING: Cell<u64> = const { Cell::new(0) };
+}
+
+fn parse(value: &[u8]) -> (u64, bool) {
+    let (digits, by_bytes) = match value {
+        [b'1', b'/', rest @ ..] => (rest, false),
+        [rest @ .., b'B'] => (rest, true),
+        rest => (rest, true),
+    };
+    let mut period: u64 = 0;
+    for digit in digits {
+        if !digit.is_ascii_digit() {
+            return (0, false);
+        }
+        period = period.saturating_mul(10).saturating_add((digit - b'0') as u64);
+    }
+    // sampling one event in one is no sampling
+    if !by_bytes && period == 1 {
+        return (0, false);
+    }
+    (period, by_bytes)
+}
+
+fn config() -> (u64, bool) {
+    let period = PERIOD.load(Ordering::Acquire);
+    if period != UNKNOWN {
+        return (period, BY_BYTES.load(Ordering::Relaxed));
+    }
+    let value = unsafe { getenv(b"RSPROF_SAMPLE\0".as_ptr() as *const c_char) };
+    let (period, by_bytes) = if value.is_null() {
+        (0, false)
+    } else {
+        parse(unsafe { CStr::from_ptr(value) }.to_bytes())
+    };
+    // threads racing here store the same values
+    BY_BYTES.store(by_bytes, Ordering::Relaxed);
+    PERIOD.store(period, Ordering::Release);
+    (period, by_bytes)
+}
+
+// uniform in (0, 1], from a xorshift generator of the thread
+fn uniform() -> f64 {
+    let mut x = RANDOM.get();
+    if x == 0 {
+        let nanos = SystemTime::now()
+            .duration_since(UNIX_EPOCH)
+            .map_or(0, |d| d.subsec_nanos() as u64);
+        x = (&x as *const u64 as u64) ^ (nanos << 20) | 1;
+    }
+    x ^= x << 13;
+    x ^= x >> 7;
+    x ^= x << 17;
+    RANDOM.set(x);
+    ((x >> 11) as f64 + 1.0) / (1u64 << 53) as f64
+}
+
+// units up to and including the next sampled one: geometric with mean period
+// for events, so that each one is sampled with probability 1 / period, and
+// exponential with mean period for bytes, so that an allocation of size bytes
+// is sampled with probability 1 - exp(-size / period)
+fn draw(period: u64, by_bytes: bool) -> u64 {
+    let u = uniform();
+    let units = if by_bytes {
+        -u.ln() * period as f64
+    } else {
+        u.ln() / (1.0 - 1.0 / period as f64).ln()
+    };
+    (units.ceil() as u64).max(1)
+}
+
+fn next_sample(units: u64, period: u64, by_bytes: bool) -> bool {
+    let mut remaining = REMAINING.get();
+    if remaining == 0 {
+        remaining = draw(period, by_bytes);
+    }
+    if units >= remaining {
+        REMAINING.set(draw(period, by_bytes));
+        return true;
+    }
+    REMAINING.set(remaining - units);
+    false
+}
+
+fn slot(address: usize) -> usize {
+    ((address as u64 >> 4).wrapping_mul(0x9E37_79B9_7F4A_7C15) >> 48) as usize
+}
+
+fn insert(address: usize) -> bool {
+    let start = slot(address);
+    for probe in 0..PROBES {
+        let entry = &SAMPLED[(start + probe) % TABLE_SIZE];
+        if entry
+            .compare_exchange(0, address, Ordering::Relaxed, Ordering::Relaxed)
+            .is_ok()
+        {
+            return true;
+        }
+    }
+    false
+}
+
+fn remove(address: usize) -> bool {
+    let start = slot(address);
+    for probe in 0..PROBES {
+        let entry = &SAMPLED[(start + probe) % TABLE_SIZE];
+        if entry
+            .compare_exchange(address, 0, Ordering::Relaxed, Ordering::Relaxed)
+            .is_ok()
+        {
+            return true;
+        }
+    }
+    false
+}
+
+// whether the event is reported to the debugger
+#[inline(always)]
+pub fn keep(event: usize, size: usize, ptr: *mut u8) -> bool {
+    let (period, by_bytes) = config();
+    if period == 0 {
+        return true;
+    }
+    if event != 0 {
+        return remove(ptr as usize);
+    }
+    if ptr.is_null() {
+        return false;
+    }
+    let units = if by_bytes { size as u64 } else { 1 };
+    // a block whose address could not be kept is not sampled, as its
+    // deallocation would be missed
+    next_sample(units, period, by_bytes) && insert(ptr as usize)
+}
@@ -1,6 +1,8 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from shlex import split
 
+from rsprof.samplingutil import Sampling
+
 EPILOG_WARNING = r"""
 warnings: 
   1. rsprof would disable other breakpoints and watchpoints, thus do not
@@ -12,6 +14,10 @@ def comma_strlist(string: str):
     return string.split(",")
 
 
+def sampling_rate(string: str):
+    return Sampling.parse(string)
+
+
 ARG_PARSER = ArgumentParser(
     prog="rsprof", formatter_class=RawDescriptionHelpFormatter, epilog=EPILOG_WARNING
 )
@@ -21,13 +27,34 @@ ARG_PARSER.add_argument(
 )
 ARG_PARSER.add_argument(
     "action",
-    choices=["enable", "disable", "report", "list"],
+    choices=["enable", "disable", "report", "dump", "list"],
     help="action on tracing modules, default to all if no module provided",
 )
 ARG_PARSER.add_argument(
     "-m", "--module", type=comma_strlist, default=list(), help="provide tracing modules"
 )
 ARG_PARSER.add_argument("-o", "--output", type=str, help="output report file")
+ARG_PARSER.add_argument(
+    "--aggregate",
+    action="store_true",
+    help="fold events into per call stack counters as they arrive (enable only)",
+)
+ARG_PARSER.add_argument(
+    "--log",
+    type=str,
+    help="append events to an event log with this prefix on disk (enable only)",
+)
+ARG_PARSER.add_argument(
+    "--frequency",
+    type=int,
+    help="samples per second of the cpu module, 99 by default (enable only)",
+)
+ARG_PARSER.add_argument(
+    "--sample",
+    type=sampling_rate,
+    help="trace one event in N on average as 1/N, or one per SIZE bytes allocated "
+    "as SIZE, e.g. 512KiB, reports are scaled to estimates (enable only)",
+)
 
 
 def parse_command(command: str):
@@ -0,0 +1,75 @@
+# demangling with an in-memory LRU cache and an optional on-disk cache for
+# each module, keyed by the UUID (build id) of the module
+
+from functools import lru_cache
+import json
+import os
+from typing import Dict, Optional
+import rust_demangler
+
+from rsprof.logutil import warn
+
+CACHE_DIR = os.environ.get(
+    "RSPROF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rsprof")
+)
+
+
+@lru_cache(maxsize=1 << 16)
+def demangle(system_name: str) -> str:
+    try:
+        return rust_demangler.demangle(system_name)
+    except:
+        return system_name
+
+
+class DemangleCache:
+    def __init__(self, uuid: Optional[str]) -> None:
+        # modules without uuid could not be told apart, keep them in memory
+        self.path = (
+            None
+            if uuid is None or uuid == ""
+            else os.path.join(CACHE_DIR, f"demangle-{uuid}.json")
+        )
+        self.names: Dict[str, str] = {}
+        self.dirty = False
+
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.names = json.load(f)
+            except (OSError, ValueError):
+                warn(f"ignore broken demangle cache '{self.path}'")
+
+    def demangle(self, system_name: str) -> str:
+        name = self.names.get(system_name)
+        if name is None:
+            name = demangle(system_name)
+            self.names[system_name] = name
+            self.dirty = True
+        return name
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # write aside and rename, so concurrent sessions never see half a file
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.names, f)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+
+_demangle_caches: Dict[str, DemangleCache] = {}
+
+
+def demangle_cache(uuid: Optional[str]) -> DemangleCache:
+    key = "" if uuid is None else uuid
+    if key not in _demangle_caches:
+        _demangle_caches[key] = DemangleCache(uuid)
+    return _demangle_caches[key]
+
+
+def save_demangle_caches():
+    for cache in _demangle_caches.values():
+        cache.save()
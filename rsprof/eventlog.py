@@ -0,0 +1,232 @@
+# append-only binary log of tracing events, spilled to disk while tracing
+#
+# <name>.log     fixed-size records, see RECORD
+# <name>.stacks  interned call stacks referenced by the records, each one is
+#                its stack id and depth followed by the pcs, innermost first
+# <name>.syms    frames of every pc of the stacks, written by `rsprof dump`
+#                while the target is still around, as json
+# <name>.sampling  sampling rate of the events, as given to `--sample`, only
+#                written when events are sampled
+#
+# Both files are only appended to, a log of a crashed session is read up to
+# its last complete record.
+
+from array import array
+from collections import namedtuple
+import json
+import os
+import struct
+import sys
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from rsprof.stackutil import StackFrame, StackTable
+
+# kinds of events
+ALLOC = 0
+DEALLOC = 1
+# addr is the address of the new block, aux the one of the reallocated block
+REALLOC = 2
+# lock events of the mutex at addr: a thread tries to lock it, gets it, and
+# unlocks it. aux of an acquisition is when it started waiting, if the target
+# measured it, 0 otherwise
+LOCK_ATTEMPT = 3
+LOCK_ACQUIRE = 4
+LOCK_RELEASE = 5
+# the thread blocks in the slow path of the mutex it tries to lock, addr is
+# the raw mutex which may not be the address of its attempt
+LOCK_WAIT = 6
+# call stack of a thread sampled by the cpu module, size is the cpu time in
+# nanoseconds the thread used since its previous sample
+CPU_SAMPLE = 7
+
+EventRecord = namedtuple(
+    "EventRecord",
+    ["kind", "thread", "size", "align", "addr", "aux", "timestamp", "stack"],
+)
+
+# index of each field of EventRecord
+KIND, THREAD, SIZE, ALIGN, ADDR, AUX, TIMESTAMP, STACK = range(0, 8)
+
+# one array per field of EventRecord, all of the same length
+Columns = Tuple[array, ...]
+
+RECORD = struct.Struct("<8Q")
+STACK_HEADER = struct.Struct("<QQ")
+
+# records are written and read in chunks of this many bytes
+CHUNK_SIZE = RECORD.size * 16384
+
+
+class EventStore:
+    # in-memory events as one array of unsigned 64 bits integers per field of
+    # EventRecord, events are not kept as objects
+    __slots__ = ("columns",)
+
+    def __init__(self) -> None:
+        self.columns = tuple(array("Q") for _ in EventRecord._fields)
+
+    def append(self, record: EventRecord):
+        for column, value in zip(self.columns, record):
+            column.append(value)
+
+    def chunks(self) -> Iterator[Columns]:
+        # events in memory make a single chunk
+        return iter((self.columns,))
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self) -> Iterator[EventRecord]:
+        return map(EventRecord, *self.columns)
+
+    def clear(self):
+        for column in self.columns:
+            del column[:]
+
+
+def stacks_path(path: str):
+    return f"{path}.stacks"
+
+
+def symbols_path(path: str):
+    return f"{path}.syms"
+
+
+def sampling_path(path: str):
+    return f"{path}.sampling"
+
+
+def write_sampling(path: str, sampling: Optional[str]):
+    # a log of events which are not sampled must not keep the sampling file of
+    # an earlier log at the same path
+    if sampling is None:
+        if os.path.exists(sampling_path(path)):
+            os.remove(sampling_path(path))
+        return
+    with open(sampling_path(path), "w") as f:
+        f.write(sampling)
+
+
+def read_sampling(path: str) -> Optional[str]:
+    # logs of events which are not sampled have no sampling file
+    try:
+        with open(sampling_path(path), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class EventLog:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records: BinaryIO = open(path, "wb", buffering=CHUNK_SIZE)
+        self.stacks: BinaryIO = open(stacks_path(path), "wb")
+        # stacks of the table already written to disk
+        self.stack_count = 0
+
+    def append(self, record: EventRecord, stacks: StackTable):
+        # stacks are written before any record referencing them, and flushed
+        # right away as the buffer of records may spill to disk at any record
+        if self.stack_count < len(stacks):
+            while self.stack_count < len(stacks):
+                pcs = stacks[self.stack_count]
+                self.stacks.write(STACK_HEADER.pack(self.stack_count, len(pcs)))
+                self.stacks.write(struct.pack(f"<{len(pcs)}Q", *pcs))
+                self.stack_count += 1
+            self.stacks.flush()
+        self.records.write(RECORD.pack(*record))
+
+    def flush(self):
+        self.stacks.flush()
+        self.records.flush()
+
+    def close(self):
+        self.stacks.close()
+        self.records.close()
+
+
+def record_count(path: str) -> int:
+    # a trailing partial record is left by an interrupted session
+    return os.path.getsize(path) // RECORD.size
+
+
+def _read_chunks(path: str, start: int, count: Optional[int]) -> Iterator[bytes]:
+    # read `count` records from the `start`-th one, or all of the remaining
+    if count is None:
+        count = record_count(path) - start
+    remaining = count * RECORD.size
+    with open(path, "rb") as f:
+        f.seek(start * RECORD.size)
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            complete = len(chunk) - len(chunk) % RECORD.size
+            yield chunk[:complete]
+            if complete < CHUNK_SIZE:
+                break
+            remaining -= complete
+
+
+def read_records(
+    path: str, start: int = 0, count: Optional[int] = None
+) -> Iterator[EventRecord]:
+    for chunk in _read_chunks(path, start, count):
+        for fields in RECORD.iter_unpack(chunk):
+            yield EventRecord._make(fields)
+
+
+def read_record_columns(
+    path: str, start: int = 0, count: Optional[int] = None
+) -> Iterator[Columns]:
+    # same as read_records, but each chunk is split into the columns of the
+    # fields, as EventStore holds them
+    fields = len(EventRecord._fields)
+    for chunk in _read_chunks(path, start, count):
+        records = array("Q")
+        records.frombytes(chunk)
+        if sys.byteorder != "little":
+            records.byteswap()
+        yield tuple(records[field::fields] for field in range(0, fields))
+
+
+def read_stacks(path: str) -> StackTable:
+    stacks = StackTable()
+    with open(stacks_path(path), "rb") as f:
+        content = f.read()
+    offset = 0
+    while offset + STACK_HEADER.size <= len(content):
+        _, depth = STACK_HEADER.unpack_from(content, offset)
+        offset += STACK_HEADER.size
+        if offset + depth * 8 > len(content):
+            break
+        pcs: Tuple[int, ...] = struct.unpack_from(f"<{depth}Q", content, offset)
+        offset += depth * 8
+        # stacks are stored in the order of their ids
+        stacks.intern(pcs)
+    return stacks
+
+
+def write_symbols(path: str, symbols: Dict[int, List[StackFrame]]):
+    with open(symbols_path(path), "w") as f:
+        json.dump(
+            {
+                str(pc): list(map(lambda x: x.serialize(), frames))
+                for pc, frames in symbols.items()
+            },
+            f,
+        )
+
+
+def read_symbols(path: str) -> Dict[int, List[StackFrame]]:
+    with open(symbols_path(path), "r") as f:
+        content = json.load(f)
+
+    symbols: Dict[int, List[StackFrame]] = {}
+    for pc, frames in content.items():
+        symbols[int(pc)] = []
+        for frame in frames:
+            stackframe = StackFrame(
+                frame["system_name"], frame["path"], frame["file"], frame["line"]
+            )
+            stackframe.name = frame["name"]
+            symbols[int(pc)].append(stackframe)
+    return symbols
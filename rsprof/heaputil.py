@@ -0,0 +1,216 @@
+# live heap of the traced program, rebuilt from allocation records by pairing
+# allocations and deallocations by address
+
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from rsprof.eventlog import ALLOC, DEALLOC, REALLOC, EventRecord
+
+
+class LiveHeap:
+    def __init__(self) -> None:
+        # outstanding blocks, address to size and allocating stack
+        self.blocks: Dict[int, Tuple[int, int]] = {}
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+        # live bytes and blocks of each allocating stack
+        self.stack_bytes: Dict[int, int] = {}
+        self.stack_blocks: Dict[int, int] = {}
+        # blocks and bytes ever allocated by each stack
+        self.allocated: Dict[int, List[int]] = {}
+
+        # bytes of each stack at the peak, saved lazily: a stack changed after
+        # the latest peak saves its value of before the change, a stack not
+        # changed since the peak still holds its value in stack_bytes
+        self.peak_generation = 0
+        self.saved_generation: Dict[int, int] = {}
+        self.saved_bytes: Dict[int, int] = {}
+
+    def _change(self, stack: int, size: int, blocks: int):
+        if self.saved_generation.get(stack) != self.peak_generation:
+            self.saved_generation[stack] = self.peak_generation
+            self.saved_bytes[stack] = self.stack_bytes.get(stack, 0)
+        self.stack_bytes[stack] = self.stack_bytes.get(stack, 0) + size
+        self.stack_blocks[stack] = self.stack_blocks.get(stack, 0) + blocks
+        self.live_bytes += size
+
+    def allocate(self, addr: int, size: int, stack: int):
+        # null is a failed allocation, or an address that was not caught
+        if addr == 0:
+            return
+        # a block never seen freed, e.g. freed before tracing started
+        if addr in self.blocks:
+            self.free(addr)
+        self.blocks[addr] = (size, stack)
+        self._change(stack, size, 1)
+        allocated = self.allocated.get(stack)
+        if allocated is None:
+            self.allocated[stack] = [1, size]
+        else:
+            allocated[0] += 1
+            allocated[1] += size
+        if self.live_bytes > self.peak_bytes:
+            self.peak_bytes = self.live_bytes
+            self.peak_generation += 1
+
+    def free(self, addr: int):
+        # blocks allocated before tracing started are not known
+        block = self.blocks.pop(addr, None)
+        if block is not None:
+            size, stack = block
+            self._change(stack, -size, -1)
+
+    def update(self, record: EventRecord):
+        if record.kind == ALLOC:
+            self.allocate(record.addr, record.size, record.stack)
+        elif record.kind == DEALLOC:
+            self.free(record.addr)
+        elif record.kind == REALLOC:
+            # the reallocated block is freed and the new one is allocated
+            self.free(record.aux)
+            self.allocate(record.addr, record.size, record.stack)
+
+    def bytes_at_peak(self, stack: int) -> int:
+        if self.saved_generation.get(stack) == self.peak_generation:
+            return self.saved_bytes[stack]
+        return self.stack_bytes.get(stack, 0)
+
+    def stacks(self):
+        # (stack, live bytes, live blocks, bytes at peak) of stacks holding
+        # memory now or at the peak
+        for stack, size in self.stack_bytes.items():
+            at_peak = self.bytes_at_peak(stack)
+            if size != 0 or at_peak != 0:
+                yield stack, size, self.stack_blocks[stack], at_peak
+
+    def clear(self):
+        self.__init__()
+
+
+class TimelineBucket:
+    __slots__ = ("live_min", "live_max", "live_end", "allocated", "sites")
+
+    def __init__(self, live_bytes: int) -> None:
+        self.live_min = live_bytes
+        self.live_max = live_bytes
+        self.live_end = live_bytes
+        self.allocated = 0
+        # bytes allocated in the bucket by each stack
+        self.sites: Dict[int, int] = {}
+
+    def sample(self, live_bytes: int):
+        self.live_min = min(self.live_min, live_bytes)
+        self.live_max = max(self.live_max, live_bytes)
+        self.live_end = live_bytes
+
+    def merge(self, other: "TimelineBucket"):
+        # other is the bucket right after this one
+        self.live_min = min(self.live_min, other.live_min)
+        self.live_max = max(self.live_max, other.live_max)
+        self.live_end = other.live_end
+        self.allocated += other.allocated
+        for stack, size in other.sites.items():
+            self.sites[stack] = self.sites.get(stack, 0) + size
+
+    def top_sites(self, count: int) -> List[Tuple[int, int]]:
+        return sorted(self.sites.items(), key=lambda x: x[1], reverse=True)[:count]
+
+
+class HeapTimeline:
+    # live bytes over time in at most MAX_BUCKETS buckets, whenever a record
+    # falls past the last bucket the width of buckets is doubled and pairs of
+    # buckets are merged, so the timeline stays small for any length of run
+    MAX_BUCKETS = 1024
+    INITIAL_WIDTH = 1_000_000
+
+    def __init__(self) -> None:
+        self.start: Optional[int] = None
+        self.width = HeapTimeline.INITIAL_WIDTH
+        self.buckets: List[TimelineBucket] = []
+
+    def _downsample(self):
+        self.width *= 2
+        buckets = self.buckets
+        self.buckets = buckets[0::2]
+        for bucket, following in zip(self.buckets, buckets[1::2]):
+            bucket.merge(following)
+
+    def update(self, record: EventRecord, live_bytes: int):
+        # live_bytes is the live heap after the record
+        if self.start is None:
+            self.start = record.timestamp
+        # records of other threads may be slightly out of order
+        index = max(0, record.timestamp - self.start) // self.width
+        while index >= HeapTimeline.MAX_BUCKETS:
+            self._downsample()
+            index = (record.timestamp - self.start) // self.width
+
+        while len(self.buckets) <= index:
+            # nothing happened in skipped buckets, the heap stayed as it was
+            live_end = self.buckets[-1].live_end if len(self.buckets) != 0 else 0
+            self.buckets.append(TimelineBucket(live_end))
+        bucket = self.buckets[index]
+        bucket.sample(live_bytes)
+        if record.kind != DEALLOC:
+            bucket.allocated += record.size
+            bucket.sites[record.stack] = bucket.sites.get(record.stack, 0) + record.size
+
+    def clear(self):
+        self.__init__()
+
+
+# upper bounds of the lifetime classes, in nanoseconds and in events
+LIFETIME_NS_BOUNDS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+LIFETIME_EVENT_BOUNDS = (10, 100, 1_000, 10_000)
+
+
+class Lifetimes:
+    def __init__(self) -> None:
+        # outstanding blocks, address to allocating stack, timestamp and the
+        # index of the allocation among all events
+        self.blocks: Dict[int, Tuple[int, int, int]] = {}
+        self.events = 0
+        # count of freed blocks of each stack per lifetime class in time,
+        # then per lifetime class in events
+        self.histograms: Dict[int, List[int]] = {}
+
+    def _allocate(self, record: EventRecord):
+        if record.addr != 0:
+            self.blocks[record.addr] = (record.stack, record.timestamp, self.events)
+
+    def _free(self, addr: int, timestamp: int):
+        block = self.blocks.pop(addr, None)
+        if block is None:
+            return
+        stack, allocated, index = block
+        histogram = self.histograms.get(stack)
+        if histogram is None:
+            histogram = self.histogram(stack)
+            self.histograms[stack] = histogram
+        histogram[bisect_left(LIFETIME_NS_BOUNDS, max(0, timestamp - allocated))] += 1
+        # events in between the allocation and the deallocation
+        histogram[
+            len(LIFETIME_NS_BOUNDS)
+            + 1
+            + bisect_left(LIFETIME_EVENT_BOUNDS, self.events - index - 1)
+        ] += 1
+
+    def update(self, record: EventRecord):
+        if record.kind == ALLOC:
+            self._allocate(record)
+        elif record.kind == DEALLOC:
+            self._free(record.addr, record.timestamp)
+        elif record.kind == REALLOC:
+            self._free(record.aux, record.timestamp)
+            self._allocate(record)
+        self.events += 1
+
+    def histogram(self, stack: int) -> List[int]:
+        histogram = self.histograms.get(stack)
+        if histogram is None:
+            return [0] * (len(LIFETIME_NS_BOUNDS) + len(LIFETIME_EVENT_BOUNDS) + 2)
+        return histogram
+
+    def clear(self):
+        self.__init__()
@@ -2,19 +2,38 @@ from dataclasses import dataclass
 from inspect import isfunction
 from re import Pattern
 import re
-from typing import Any, Callable, List, Literal, Optional, Tuple, Union
+import struct
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 from lldb import (
+    SBAddress,
     SBDebugger,
+    SBEnvironment,
+    SBError,
+    SBLaunchInfo,
+    SBProcess,
     SBTarget,
     SBFrame,
     SBBreakpointLocation,
     SBBreakpoint,
     SBValue,
     SBModule,
-    SBSymbol
+    SBSymbol,
+    SBSymbolContextList,
+    eByteOrderLittle,
 )
 
 from rsprof.logutil import fail, info, warn
+from rsprof.symbolutil import INVALID_ADDRESS, target_symbol_indexes
 
 
 def import_lldb_command(lldb_debugger: SBDebugger, item):
@@ -48,6 +67,9 @@ class BrType:
     NAME = 2
     REGEX = 3
     SRCLOC = 4
+    # regex on the names demangled by rsprof, which are the same for legacy
+    # and v0 mangling whatever the demangler of lldb makes of them
+    RUSTREGEX = 5
 
 
 @dataclass
@@ -75,6 +97,13 @@ class BrRegistration:
         return self.pattern.__str__()
 
 
+def _combine_patterns(registrations: List[BrRegistration]) -> Optional[Pattern]:
+    if len(registrations) == 0:
+        return None
+    return re.compile(
+        "|".join(f"(?:{r.pattern.pattern})" for r in registrations))
+
+
 @dataclass
 class BrRecord:
     target: SBTarget
@@ -121,6 +150,14 @@ class BreakpointManager:
         self.br_registra.append(BrRegistration(
             re.compile(regex), BrType.REGEX, callback))
 
+    def br_rustregex(
+        self,
+        regex: str,
+        callback: Callable[[SBFrame, SBBreakpointLocation, Any, Any], None],
+    ):
+        self.br_registra.append(BrRegistration(
+            re.compile(regex), BrType.RUSTREGEX, callback))
+
     def update(self, debugger: SBDebugger):
         self.reg_brs = list(
             filter(
@@ -129,12 +166,43 @@ class BreakpointManager:
             )
         )
 
-    def _enumerate_symbols(self, target: SBTarget):
-        for i in range(0, target.GetNumModules()):
-            module: SBModule = target.GetModuleAtIndex(i)
-            for si in range(0, module.GetNumSymbols()):
-                symbol: SBSymbol = module.GetSymbolAtIndex(si)
-                yield symbol
+    def _find_symbols(self, target: SBTarget, names: Iterable[str]):
+        # let lldb look the names up in its own symbol index, a symbol may be
+        # found by both of its names so report each one only once
+        seen = set()
+        for name in names:
+            contexts: SBSymbolContextList = target.FindSymbols(name)
+            for ci in range(0, contexts.GetSize()):
+                symbol: SBSymbol = contexts.GetContextAtIndex(ci).GetSymbol()
+                if not symbol.IsValid():
+                    continue
+                address: SBAddress = symbol.GetStartAddress()
+                module: SBModule = address.GetModule()
+                key = (module.GetFileSpec().fullpath, address.GetFileAddress())
+                if key not in seen:
+                    seen.add(key)
+                    sym_name = _not_none(symbol.GetName())
+                    sym_sysname = symbol.GetMangledName()
+                    yield (
+                        sym_name,
+                        sym_name if sym_sysname is None else sym_sysname,
+                        "",
+                        module,
+                        address.GetFileAddress(),
+                    )
+
+    def _indexed_symbols(self, target: SBTarget, demangled: bool):
+        # demangled names are only computed, and cached, if asked for
+        for module, index in target_symbol_indexes(target):
+            names = index.demangled() if demangled else None
+            for si in range(0, len(index)):
+                yield (
+                    index.names[si],
+                    index.sysname(si),
+                    "" if names is None else names[si],
+                    module,
+                    index.addresses[si],
+                )
 
     def _set_bp(self, bp: SBBreakpoint, pattern: BrRegistration):
         bp.SetAutoContinue(True)
@@ -164,15 +232,56 @@ class BreakpointManager:
                     unresolved = True
                 new_brs.append(bp.id)
 
-        # now handle all symbols, filter them and set breakpoints for demangled name
-        for symbol in self._enumerate_symbols(target):
-            for registration in self.br_registra:
-                if registration.regtype != BrType.SRCLOC and registration.match(symbol):
-                    bp: SBBreakpoint = target.BreakpointCreateBySBAddress(
-                        symbol.GetStartAddress())
-                    if not self._set_bp(bp, registration):
-                        unresolved = True
-                    new_brs.append(bp.id)
+        # exact names are matched by hash lookup, and all regexes of the same
+        # type are merged so that each symbol is scanned once for them
+        names: Dict[str, List[BrRegistration]] = {}
+        sysnames: Dict[str, List[BrRegistration]] = {}
+        regexes: List[BrRegistration] = []
+        sysregexes: List[BrRegistration] = []
+        rustregexes: List[BrRegistration] = []
+        for registration in self.br_registra:
+            if registration.regtype == BrType.NAME:
+                names.setdefault(registration.pattern, []).append(registration)
+            elif registration.regtype == BrType.SYSNAME:
+                sysnames.setdefault(registration.pattern, []).append(registration)
+            elif registration.regtype == BrType.REGEX:
+                regexes.append(registration)
+            elif registration.regtype == BrType.SYSREGEX:
+                sysregexes.append(registration)
+            elif registration.regtype == BrType.RUSTREGEX:
+                rustregexes.append(registration)
+        regex = _combine_patterns(regexes)
+        sysregex = _combine_patterns(sysregexes)
+        rustregex = _combine_patterns(rustregexes)
+
+        if regex is None and sysregex is None and rustregex is None:
+            # without regexes only the registered names have to be visited
+            symbols = self._find_symbols(
+                target, set(names.keys()) | set(sysnames.keys()))
+        else:
+            # otherwise go through the persistent symbol index of each module
+            symbols = self._indexed_symbols(target, rustregex is not None)
+
+        for name, sysname, demangled, module, file_address in symbols:
+            matched: List[BrRegistration] = []
+            matched.extend(names.get(name, ()))
+            matched.extend(sysnames.get(sysname, ()))
+            # the merged pattern only filters, find out which ones matched
+            if regex is not None and regex.match(name) is not None:
+                matched.extend(r for r in regexes if r.pattern.match(name))
+            if sysregex is not None and sysregex.match(sysname) is not None:
+                matched.extend(r for r in sysregexes if r.pattern.match(sysname))
+            if rustregex is not None and rustregex.match(demangled) is not None:
+                matched.extend(r for r in rustregexes if r.pattern.match(demangled))
+
+            if len(matched) == 0 or file_address == INVALID_ADDRESS:
+                continue
+            address: SBAddress = module.ResolveFileAddress(file_address)
+            for registration in matched:
+                bp: SBBreakpoint = target.BreakpointCreateBySBAddress(address)
+                if not self._set_bp(bp, registration):
+                    unresolved = True
+                new_brs.append(bp.id)
 
         self.reg_brs.append(BrRecord(target, new_brs))
         info(f"totally {len(new_brs)} breakpoints set")
@@ -182,6 +291,24 @@ class BreakpointManager:
         else:
             return BreakpointManager.NO_UNRESOLVED
 
+    def br_address(
+        self,
+        target: SBTarget,
+        address: int,
+        callback: Callable[[SBFrame, SBBreakpointLocation, Any, Any], None],
+    ) -> Optional[int]:
+        # breakpoint set while tracing, e.g. at a return address, it is
+        # deleted together with the registered ones of the target
+        for reg in self.reg_brs:
+            if reg.target == target:
+                bp: SBBreakpoint = target.BreakpointCreateByAddress(address)
+                bp.SetAutoContinue(True)
+                bp.SetScriptCallbackFunction(
+                    f"{callback.__module__}.{callback.__qualname__}")
+                reg.brs.append(bp.id)
+                return bp.id if bp.GetNumLocations() != 0 else None
+        return None
+
     def unset(self, target: SBTarget):
         for index, rec in enumerate(self.reg_brs):
             if rec.target == target:
@@ -192,11 +319,58 @@ class BreakpointManager:
         return False
 
 
+def read_memory_struct(
+    process: SBProcess, address: int, format: str
+) -> Optional[Tuple[Any, ...]]:
+    # unpack memory of the target with its own byte order
+    byte_order = "<" if process.GetByteOrder() == eByteOrderLittle else ">"
+    layout = struct.Struct(byte_order + format)
+    error = SBError()
+    content = process.ReadMemory(address, layout.size, error)
+    if not error.Success():
+        return None
+    return layout.unpack(content)
+
+
 def evaluate_expression_unsigned(frame: SBFrame, expression: str) -> int:
     return frame.EvaluateExpression(expression).GetValueAsUnsigned()
 
 
-def get_function_parameter(frame: SBFrame, nargs: Tuple[Literal["s", "u"], ...]):
+# integer argument registers of the supported calling conventions, keyed by
+# the architecture part of the target triple
+ARGUMENT_REGISTERS = {
+    # System V AMD64 ABI
+    "x86_64": ("rdi", "rsi", "rdx", "rcx", "r8", "r9"),
+    # AAPCS64
+    "aarch64": ("x0", "x1", "x2", "x3", "x4", "x5", "x6", "x7"),
+    "arm64": ("x0", "x1", "x2", "x3", "x4", "x5", "x6", "x7"),
+}
+
+# register holding integer return values, keyed like ARGUMENT_REGISTERS
+RETURN_REGISTERS = {
+    "x86_64": "rax",
+    "aarch64": "x0",
+    "arm64": "x0",
+}
+
+_argument_registers_cache: Dict[str, Tuple[str, ...]] = {}
+
+
+def argument_registers(target: SBTarget) -> Tuple[str, ...]:
+    triple = target.GetTriple()
+    if triple not in _argument_registers_cache:
+        arch = _not_none(triple).split("-")[0]
+        # windows x64 does not follow the system v convention
+        if "windows" in _not_none(triple):
+            _argument_registers_cache[triple] = ()
+        else:
+            _argument_registers_cache[triple] = ARGUMENT_REGISTERS.get(arch, ())
+    return _argument_registers_cache[triple]
+
+
+def _get_function_parameter_by_expression(
+    frame: SBFrame, nargs: Tuple[Literal["s", "u"], ...]
+):
     ret_value: List[int] = []
     for id, s in enumerate(nargs):
         arg_value: SBValue = frame.EvaluateExpression(f"$arg{id + 1}")
@@ -204,3 +378,44 @@ def get_function_parameter(frame: SBFrame, nargs: Tuple[Literal["s", "u"], ...])
             arg_value.GetValueAsUnsigned() if s == "u" else arg_value.GetValueAsSigned()
         )
     return tuple(ret_value)
+
+
+def get_function_parameter(frame: SBFrame, nargs: Tuple[Literal["s", "u"], ...]):
+    # read integer arguments straight from the argument registers of the calling
+    # convention, only valid at the entry of the function like "$argN" is
+    registers = argument_registers(frame.GetThread().GetProcess().GetTarget())
+    if len(nargs) > len(registers):
+        return _get_function_parameter_by_expression(frame, nargs)
+
+    ret_value: List[int] = []
+    for register, s in zip(registers, nargs):
+        arg_value: SBValue = frame.FindRegister(register)
+        if not arg_value.IsValid():
+            return _get_function_parameter_by_expression(frame, nargs)
+        ret_value.append(
+            arg_value.GetValueAsUnsigned() if s == "u" else arg_value.GetValueAsSigned()
+        )
+    return tuple(ret_value)
+
+
+def set_launch_environment(target: SBTarget, name: str, value: Optional[str]):
+    # variable of the environment of the processes the target launches, unset
+    # when value is None so that an earlier enable does not leak into them
+    launch_info: SBLaunchInfo = target.GetLaunchInfo()
+    if value is None:
+        environment: SBEnvironment = launch_info.GetEnvironment()
+        environment.Unset(name)
+        launch_info.SetEnvironment(environment, False)
+    else:
+        launch_info.SetEnvironmentEntries([f"{name}={value}"], True)
+    target.SetLaunchInfo(launch_info)
+
+
+def get_function_return(frame: SBFrame) -> Optional[int]:
+    # integer return value, only valid right after the function returned
+    triple = _not_none(frame.GetThread().GetProcess().GetTarget().GetTriple())
+    register = RETURN_REGISTERS.get(triple.split("-")[0])
+    if register is None:
+        return None
+    value: SBValue = frame.FindRegister(register)
+    return value.GetValueAsUnsigned() if value.IsValid() else None
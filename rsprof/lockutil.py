@@ -0,0 +1,275 @@
+# lock contention of the traced program, rebuilt from lock records: the time
+# spent by threads waiting for mutexes and holding them
+
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from rsprof.eventlog import (
+    LOCK_ACQUIRE,
+    LOCK_ATTEMPT,
+    LOCK_RELEASE,
+    LOCK_WAIT,
+    EventRecord,
+)
+
+# indexes of the statistics of a call site or a mutex
+ACQUISITIONS = 0
+CONTENTIONS = 1
+WAIT_TIME = 2
+MAX_WAIT_TIME = 3
+HOLD_TIME = 4
+MAX_HOLD_TIME = 5
+
+
+def _statistics(table: Dict[int, List[int]], key: int) -> List[int]:
+    statistics = table.get(key)
+    if statistics is None:
+        statistics = [0] * 6
+        table[key] = statistics
+    return statistics
+
+
+class LockContention:
+    def __init__(self) -> None:
+        # attempts not acquired yet, thread to mutex and time of the attempt,
+        # and whether another thread held the mutex then
+        self.attempts: Dict[int, Tuple[int, int, bool]] = {}
+        # held mutexes, mutex to owning thread, call site and acquire time
+        self.owners: Dict[int, Tuple[int, int, int]] = {}
+
+        # statistics of each acquiring call site and of each mutex
+        self.sites: Dict[int, List[int]] = {}
+        self.mutexes: Dict[int, List[int]] = {}
+        # wait time of each (mutex, call site)
+        self.site_waits: Dict[Tuple[int, int], int] = {}
+
+    def _contended(self, mutex: int, thread: int) -> bool:
+        owner = self.owners.get(mutex)
+        return owner is not None and owner[0] != thread
+
+    def attempt(self, mutex: int, thread: int, timestamp: int):
+        # the same attempt may be reported by several layers of hooks, e.g.
+        # RsprofMutex and the std::sync::Mutex it wraps, keep the first one
+        attempt = self.attempts.get(thread)
+        if attempt is not None and attempt[0] == mutex:
+            return
+        self.attempts[thread] = (mutex, timestamp, self._contended(mutex, thread))
+
+    def wait(self, thread: int):
+        # a thread only blocks inside its latest attempt
+        attempt = self.attempts.get(thread)
+        if attempt is not None:
+            self.attempts[thread] = (attempt[0], attempt[1], True)
+
+    def acquire(
+        self, mutex: int, thread: int, stack: int, timestamp: int, since: int = 0
+    ):
+        # mutexes are not reentrant, the thread owning the mutex already is the
+        # same acquisition reported by another layer of hooks
+        owner = self.owners.get(mutex)
+        if owner is not None and owner[0] == thread:
+            return
+        wait = 0
+        contended = self._contended(mutex, thread)
+        attempt = self.attempts.pop(thread, None)
+        # the attempt is missing if its hook could not be set
+        if attempt is not None and attempt[0] == mutex:
+            contended = contended or attempt[2]
+            # since is when the target itself started waiting, the time of
+            # the attempt also counts the stop of the debugger at its hook
+            since = since or attempt[1]
+        # an uncontended acquisition only waited for the hooks
+        if contended and since:
+            wait = max(0, timestamp - since)
+        self.owners[mutex] = (thread, stack, timestamp)
+
+        for statistics in (
+            _statistics(self.sites, stack),
+            _statistics(self.mutexes, mutex),
+        ):
+            statistics[ACQUISITIONS] += 1
+            statistics[CONTENTIONS] += 1 if contended else 0
+            statistics[WAIT_TIME] += wait
+            statistics[MAX_WAIT_TIME] = max(statistics[MAX_WAIT_TIME], wait)
+        key = (mutex, stack)
+        self.site_waits[key] = self.site_waits.get(key, 0) + wait
+
+    def release(self, mutex: int, timestamp: int):
+        # mutexes locked before tracing started are not known
+        owner = self.owners.pop(mutex, None)
+        if owner is None:
+            return
+        _, stack, acquired = owner
+        hold = max(0, timestamp - acquired)
+        for statistics in (
+            _statistics(self.sites, stack),
+            _statistics(self.mutexes, mutex),
+        ):
+            statistics[HOLD_TIME] += hold
+            statistics[MAX_HOLD_TIME] = max(statistics[MAX_HOLD_TIME], hold)
+
+    def update(self, record: EventRecord):
+        if record.kind == LOCK_ATTEMPT:
+            self.attempt(record.addr, record.thread, record.timestamp)
+        elif record.kind == LOCK_ACQUIRE:
+            self.acquire(
+                record.addr, record.thread, record.stack, record.timestamp, record.aux
+            )
+        elif record.kind == LOCK_RELEASE:
+            self.release(record.addr, record.timestamp)
+        elif record.kind == LOCK_WAIT:
+            self.wait(record.thread)
+
+    def top_mutexes(self, count: int) -> List[Tuple[int, List[int]]]:
+        # mutexes threads waited for the longest
+        return sorted(
+            self.mutexes.items(), key=lambda x: (x[1][WAIT_TIME], x[1][CONTENTIONS])
+        )[::-1][:count]
+
+    def worst_site(self, mutex: int) -> int:
+        # call site that waited the longest for the mutex
+        return max(
+            (item for item in self.site_waits.items() if item[0][0] == mutex),
+            key=lambda x: x[1],
+        )[0][1]
+
+    def clear(self):
+        self.__init__()
+
+
+class LockEdge(NamedTuple):
+    # `acquired` was locked by `thread` at `acquired_stack` while it held
+    # `held`, which it locked at `held_stack`
+    held: int
+    acquired: int
+    thread: int
+    held_stack: int
+    acquired_stack: int
+
+
+class LockOrder:
+    # order in which threads nest mutexes: an edge from a mutex to another is
+    # added the first time a thread locks the latter while holding the former,
+    # and a cycle of edges is an order that could deadlock
+    #
+    # cycles are found as edges are added by keeping a topological order of
+    # the mutexes (Pearce and Kelly, "A dynamic topological sort algorithm for
+    # directed acyclic graphs"), an edge agreeing with the order is added in
+    # constant time, otherwise only the mutexes in between its ends in the
+    # order are visited and reordered
+    def __init__(self) -> None:
+        # mutexes held by each thread and where they were locked, in the order
+        # of locking
+        self.held: Dict[int, List[Tuple[int, int]]] = {}
+
+        # edges of the graph without the ones closing a cycle, by mutex
+        self.successors: Dict[int, Dict[int, LockEdge]] = {}
+        self.predecessors: Dict[int, Set[int]] = {}
+        # position of each mutex in the topological order
+        self.order: Dict[int, int] = {}
+
+        # cycles found, each one as its edges from the one closing it, and
+        # the edges closing them which are left out of the graph
+        self.cycles: List[List[LockEdge]] = []
+        self.closing: Set[Tuple[int, int]] = set()
+
+    def _node(self, mutex: int) -> int:
+        position = self.order.get(mutex)
+        if position is None:
+            position = len(self.order)
+            self.order[mutex] = position
+            self.successors[mutex] = {}
+            self.predecessors[mutex] = set()
+        return position
+
+    def _forward(self, start: int, target: int, bound: int):
+        # mutexes reachable from start and not after bound in the order, with
+        # the edge each one was reached by, stops early once target is reached
+        reached: Dict[int, LockEdge] = {}
+        visited = {start}
+        pending = [start]
+        while len(pending) != 0:
+            mutex = pending.pop()
+            for successor, edge in self.successors[mutex].items():
+                if successor in visited or self.order[successor] > bound:
+                    continue
+                visited.add(successor)
+                reached[successor] = edge
+                if successor == target:
+                    return visited, reached
+                pending.append(successor)
+        return visited, reached
+
+    def _backward(self, start: int, bound: int) -> Set[int]:
+        # mutexes reaching start and not before bound in the order
+        visited = {start}
+        pending = [start]
+        while len(pending) != 0:
+            mutex = pending.pop()
+            for predecessor in self.predecessors[mutex]:
+                if predecessor not in visited and self.order[predecessor] >= bound:
+                    visited.add(predecessor)
+                    pending.append(predecessor)
+        return visited
+
+    def add_edge(self, edge: LockEdge):
+        source, target = edge.held, edge.acquired
+        if target in self.successors.get(source, ()):
+            return
+        if (source, target) in self.closing:
+            return
+        lower, upper = self._node(target), self._node(source)
+
+        if lower < upper:
+            forward, reached = self._forward(target, source, upper)
+            if source in forward:
+                # the path back from target to source closes the cycle
+                cycle = [edge]
+                mutex = source
+                path = []
+                while mutex != target:
+                    path.append(reached[mutex])
+                    mutex = reached[mutex].held
+                cycle.extend(reversed(path))
+                self.cycles.append(cycle)
+                self.closing.add((source, target))
+                return
+
+            # move the mutexes reaching source before the ones reached from
+            # target, reusing their positions
+            backward = self._backward(source, lower)
+            mutexes = sorted(backward, key=self.order.__getitem__) + sorted(
+                forward, key=self.order.__getitem__
+            )
+            positions = sorted(self.order[mutex] for mutex in mutexes)
+            for mutex, position in zip(mutexes, positions):
+                self.order[mutex] = position
+
+        self.successors[source][target] = edge
+        self.predecessors[target].add(source)
+
+    def acquire(self, mutex: int, thread: int, stack: int):
+        held = self.held.setdefault(thread, [])
+        # the same acquisition reported by another layer of hooks
+        if any(held_mutex == mutex for held_mutex, _ in held):
+            return
+        for held_mutex, held_stack in held:
+            self.add_edge(LockEdge(held_mutex, mutex, thread, held_stack, stack))
+        held.append((mutex, stack))
+
+    def release(self, mutex: int, thread: int):
+        # guards are released by the thread which locked them, though not
+        # always in the reverse order of locking
+        held = self.held.get(thread, [])
+        for index in range(len(held) - 1, -1, -1):
+            if held[index][0] == mutex:
+                del held[index]
+                return
+
+    def update(self, record: EventRecord):
+        if record.kind == LOCK_ACQUIRE:
+            self.acquire(record.addr, record.thread, record.stack)
+        elif record.kind == LOCK_RELEASE:
+            self.release(record.addr, record.thread)
+
+    def clear(self):
+        self.__init__()
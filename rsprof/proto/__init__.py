@@ -1,9 +1,18 @@
 from dataclasses import dataclass
-import json
-from typing import Dict, Generic, List, Optional, Tuple, TypeVar, Union
-from rsprof.traceutil import StackFrame, StackTrace
-from google.protobuf import json_format
-from rsprof.proto.profile_pb2 import Profile
+from operator import add
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from rsprof.stackutil import StackFrame, StackTrace
+from rsprof.proto.writer import ProfileWriter
 
 
 class ToJson:
@@ -16,12 +25,27 @@ T = TypeVar("T", bound=ToJson)
 
 class Table(Generic[T]):
     def __init__(self) -> None:
+        self.alloca_table: Dict[Hashable, int] = {}
         self.elemen_table: List[T] = []
 
     def update(self, element: T) -> int:
         self.elemen_table.append(element)
         return len(self.elemen_table)
 
+    def intern(self, key: Hashable, factory: Callable[[], T]) -> int:
+        # ids are 1-based, 0 is reserved for "no element" in the profile
+        if key in self.alloca_table:
+            return self.alloca_table[key]
+        element_id = self.update(factory())
+        self.alloca_table[key] = element_id
+        return element_id
+
+    def __getitem__(self, element_id: int) -> T:
+        return self.elemen_table[element_id - 1]
+
+    def __len__(self):
+        return len(self.elemen_table)
+
     def to_json(self):
         l = []
         for id, element in enumerate(self.elemen_table):
@@ -103,13 +127,13 @@ class Location(ToJson):
 class Context(ToJson):
     location_id: int
     parent_id: int
-    children_id: int
+    children_id: List[int]
 
     def to_json(self):
         return {
             "location_id": self.location_id,
             "parent_id": self.parent_id,
-            "children_id": [self.children_id],
+            "children_id": self.children_id,
         }
 
 
@@ -119,8 +143,13 @@ class Event:
     values: List[int]
 
 
+# metric types are (unit, description), optionally followed by the function
+# combining two values of the metric, which is a sum by default
+MetricType = Union[Tuple[str, str], Tuple[str, str, Callable[[int, int], int]]]
+
+
 class ProfileBuilder:
-    def __init__(self, *metric_type: Tuple[str, str]) -> None:
+    def __init__(self, *metric_type: MetricType) -> None:
         # internal string table for serialization
         self.strings = StringTable()
 
@@ -135,71 +164,136 @@ class ProfileBuilder:
                 metric_type,
             )
         )
+        self.combines = [x[2] if len(x) > 2 else add for x in metric_type]
 
-        self.samples = []
+        # summed metrics of each context, keyed by context id
+        self.samples: Dict[int, List[int]] = {}
 
+        # calling context tree, contexts are merged by (parent, location) and
+        # everything below them is interned by identity
         self.contexts = Table[Context]()
         self.locations = Table[Location]()
         self.functions = Table[Function]()
         self.source_files = Table[SourceFile]()
 
-    def make_context(self, location_id: int):
-        context = Context(location_id, 0, 0)
-        return context, self.contexts.update(context)
+    def make_context(self, parent_id: int, location_id: int):
+        def factory():
+            if parent_id != 0:
+                self.contexts[parent_id].children_id.append(
+                    len(self.contexts) + 1)
+            return Context(location_id, parent_id, [])
+
+        return self.contexts.intern((parent_id, location_id), factory)
 
     def make_location(self, stackframe: StackFrame):
-        source_file_id = self.source_files.update(
-            SourceFile(
-                self.strings.update(stackframe.file),
-                self.strings.update(stackframe.path),
-                0,
-            )
+        filename = self.strings.update(stackframe.file)
+        location_path = self.strings.update(stackframe.path)
+        source_file_id = self.source_files.intern(
+            (filename, location_path),
+            lambda: SourceFile(filename, location_path, 0),
         )
 
-        function_id = self.functions.update(
-            Function(
-                self.strings.update(stackframe.name),
-                self.strings.update(stackframe.system_name),
-                source_file_id,
-                stackframe.line,
-            )
+        name = self.strings.update(stackframe.name)
+        system_name = self.strings.update(stackframe.system_name)
+        function_id = self.functions.intern(
+            (name, system_name, source_file_id),
+            lambda: Function(name, system_name,
+                             source_file_id, stackframe.line),
+        )
+
+        return self.locations.intern(
+            (function_id, stackframe.line),
+            lambda: Location(function_id, stackframe.line),
         )
-        return self.locations.update(Location(function_id, stackframe.line))
 
     def add_context_from_stacktrace(self, stacktrace: StackTrace):
-        parent_context_id = 0
-        parent_context = None
+        context_id = 0
         for frame in reversed(stacktrace.frames):
-            location_id = self.make_location(frame)
-            context, context_id = self.make_context(location_id)
+            context_id = self.make_context(
+                context_id, self.make_location(frame))
+        return context_id
+
+    def add_sample(self, context_id: int, values: List[int]):
+        metric = self.samples.get(context_id)
+        if metric is None:
+            self.samples[context_id] = list(values)
+        else:
+            for index, value in enumerate(values):
+                metric[index] = self.combines[index](metric[index], value)
 
-            # make parent
-            context.parent_id = parent_context_id
+    def add_event(self, event: Event):
+        self.add_sample(
+            self.add_context_from_stacktrace(event.stacktrace), event.values
+        )
 
-            # make child
-            if parent_context is not None:
-                parent_context.children_id = context_id
+    def merge(self, other: "ProfileBuilder"):
+        # merge the calling context tree and samples of another builder with
+        # the same metrics, ids of `other` are mapped to ids of this builder
+        if len(other.metric_type) != len(self.metric_type):
+            raise ValueError("unable to merge profiles of different metrics")
+
+        strings = list(map(self.strings.update, other.strings.strings))
+
+        source_files = [0]
+        for source_file in other.source_files.elemen_table:
+            filename = strings[source_file.filename]
+            location_path = strings[source_file.location_path]
+            source_files.append(
+                self.source_files.intern(
+                    (filename, location_path),
+                    lambda: SourceFile(filename, location_path, source_file.type),
+                )
+            )
 
-            # swap
-            parent_context_id = context_id
-            parent_context = context
+        functions = [0]
+        for function in other.functions.elemen_table:
+            name = strings[function.name]
+            system_name = strings[function.system_name]
+            source_file_id = source_files[function.source_file_id]
+            functions.append(
+                self.functions.intern(
+                    (name, system_name, source_file_id),
+                    lambda: Function(
+                        name, system_name, source_file_id, function.start_line
+                    ),
+                )
+            )
 
-        return parent_context_id
+        locations = [0]
+        for location in other.locations.elemen_table:
+            function_id = functions[location.function_id]
+            locations.append(
+                self.locations.intern(
+                    (function_id, location.line),
+                    lambda: Location(function_id, location.line),
+                )
+            )
 
-    def add_event(self, event: Event):
-        metric = list(
-            map(
-                lambda x: {"int_value": x, "uint_value": 0, "str_value": 0},
-                event.values,
+        # parents are always created before their children
+        contexts = [0]
+        for context in other.contexts.elemen_table:
+            contexts.append(
+                self.make_context(
+                    contexts[context.parent_id], locations[context.location_id]
+                )
             )
-        )
-        context_id = self.add_context_from_stacktrace(event.stacktrace)
-        self.samples.append({"context_id": context_id, "metric": metric})
+
+        for context_id, metric in other.samples.items():
+            self.add_sample(contexts[context_id], metric)
 
     def to_json(self):
         return {
             "metric_type": self.metric_type,
-            "sample": self.samples,
+            "sample": [
+                {
+                    "context_id": context_id,
+                    "metric": [
+                        {"int_value": x, "uint_value": 0, "str_value": 0}
+                        for x in metric
+                    ],
+                }
+                for context_id, metric in self.samples.items()
+            ],
             # context of samples
             "context": self.contexts.to_json(),
             # location of samples
@@ -210,7 +304,32 @@ class ProfileBuilder:
         }
 
     def write_file(self, filename: str):
-        profile = Profile()
-        s = json.dumps(self.to_json())
         with open(filename, "wb") as f:
-            f.write(json_format.Parse(s, profile).SerializeToString())
+            writer = ProfileWriter(f)
+            for metric_type in self.metric_type:
+                writer.metric_type(
+                    metric_type["value_type"], metric_type["unit"], metric_type["des"]
+                )
+            for context_id, metric in self.samples.items():
+                writer.sample(context_id, metric)
+            for id, context in enumerate(self.contexts.elemen_table, 1):
+                writer.context(
+                    id, context.location_id, context.parent_id, context.children_id
+                )
+            for id, location in enumerate(self.locations.elemen_table, 1):
+                writer.location(id, location.function_id, location.line)
+            for id, function in enumerate(self.functions.elemen_table, 1):
+                writer.function(
+                    id,
+                    function.name,
+                    function.system_name,
+                    function.source_file_id,
+                    function.start_line,
+                )
+            for id, source_file in enumerate(self.source_files.elemen_table, 1):
+                writer.source_file(
+                    id, source_file.filename, source_file.location_path, source_file.type
+                )
+            for string in self.strings.strings:
+                writer.string(string)
+            writer.flush()
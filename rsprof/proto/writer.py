@@ -0,0 +1,129 @@
+# protobuf wire format encoder for drcctprof.profile.Profile, see profile.proto
+#
+# The profile is a sequence of repeated fields of the top level message, which
+# protobuf allows to appear in any order and interleaved, so every element is
+# encoded and appended on its own and the file is written chunk by chunk.
+
+from typing import BinaryIO, Iterable
+
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+# field numbers of message Profile
+_PROFILE_METRIC_TYPE = 1
+_PROFILE_SAMPLE = 2
+_PROFILE_CONTEXT = 3
+_PROFILE_LOCATION = 4
+_PROFILE_FUNCTION = 5
+_PROFILE_SOURCE_FILE = 6
+_PROFILE_STRING_TABLE = 7
+
+
+def _varint(buffer: bytearray, value: int):
+    # negative int64 are encoded as their 64 bits two's complement
+    if value < 0:
+        value += 1 << 64
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _key(buffer: bytearray, field: int, wire_type: int):
+    _varint(buffer, (field << 3) | wire_type)
+
+
+def _int_field(buffer: bytearray, field: int, value: int):
+    # proto3 does not encode scalar fields holding the default value
+    if value != 0:
+        _key(buffer, field, _VARINT)
+        _varint(buffer, value)
+
+
+def _bytes_field(buffer: bytearray, field: int, value: bytes):
+    _key(buffer, field, _LENGTH_DELIMITED)
+    _varint(buffer, len(value))
+    buffer += value
+
+
+def _packed_field(buffer: bytearray, field: int, values: Iterable[int]):
+    packed = bytearray()
+    for value in values:
+        _varint(packed, value)
+    if len(packed) != 0:
+        _bytes_field(buffer, field, packed)
+
+
+class ProfileWriter:
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.buffer = bytearray()
+
+    def _message(self, field: int, message: bytearray):
+        _bytes_field(self.buffer, field, message)
+        if len(self.buffer) >= ProfileWriter.CHUNK_SIZE:
+            self.flush()
+
+    def metric_type(self, value_type: int, unit: int, des: int):
+        message = bytearray()
+        _int_field(message, 1, value_type)
+        _int_field(message, 2, unit)
+        _int_field(message, 3, des)
+        self._message(_PROFILE_METRIC_TYPE, message)
+
+    def sample(self, context_id: int, metric: Iterable[int]):
+        message = bytearray()
+        _int_field(message, 1, context_id)
+        for int_value in metric:
+            value = bytearray()
+            _int_field(value, 1, int_value)
+            _bytes_field(message, 2, value)
+        self._message(_PROFILE_SAMPLE, message)
+
+    def context(
+        self, id: int, location_id: int, parent_id: int, children_id: Iterable[int]
+    ):
+        message = bytearray()
+        _int_field(message, 1, id)
+        _int_field(message, 2, location_id)
+        _int_field(message, 3, parent_id)
+        _packed_field(message, 4, children_id)
+        self._message(_PROFILE_CONTEXT, message)
+
+    def location(self, id: int, function_id: int, line: int):
+        message = bytearray()
+        _int_field(message, 1, id)
+        value = bytearray()
+        _int_field(value, 1, function_id)
+        _int_field(value, 2, line)
+        _bytes_field(message, 2, value)
+        self._message(_PROFILE_LOCATION, message)
+
+    def function(
+        self, id: int, name: int, system_name: int, source_file_id: int, start_line: int
+    ):
+        message = bytearray()
+        _int_field(message, 1, id)
+        _int_field(message, 2, name)
+        _int_field(message, 3, system_name)
+        _int_field(message, 4, source_file_id)
+        _int_field(message, 5, start_line)
+        self._message(_PROFILE_FUNCTION, message)
+
+    def source_file(self, id: int, filename: int, location_path: int, type: int):
+        message = bytearray()
+        _int_field(message, 1, id)
+        _int_field(message, 2, filename)
+        _int_field(message, 3, location_path)
+        _int_field(message, 4, type)
+        self._message(_PROFILE_SOURCE_FILE, message)
+
+    def string(self, string: str):
+        # strings of the table are always written, index 0 must be ""
+        self._message(_PROFILE_STRING_TABLE, string.encode("utf-8"))
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
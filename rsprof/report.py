@@ -0,0 +1,757 @@
+# report generation that does not depend on lldb, shared by the tracing
+# modules and the offline reporter which runs in its own process:
+#
+#   python -m rsprof.report trace.memtrace.log -o out [-j jobs]
+#
+# the log is written with `rsprof --log trace enable` or `rsprof dump`
+
+from argparse import ArgumentParser
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from rsprof.eventlog import (
+    ADDR,
+    ALIGN,
+    ALLOC,
+    CPU_SAMPLE,
+    KIND,
+    REALLOC,
+    SIZE,
+    STACK,
+    Columns,
+    EventRecord,
+    read_record_columns,
+    read_records,
+    read_stacks,
+    record_count,
+    read_sampling,
+    read_symbols,
+    stacks_path,
+    symbols_path,
+)
+from rsprof.heaputil import HeapTimeline, Lifetimes, LiveHeap
+from rsprof.lockutil import (
+    ACQUISITIONS,
+    CONTENTIONS,
+    HOLD_TIME,
+    MAX_HOLD_TIME,
+    MAX_WAIT_TIME,
+    WAIT_TIME,
+    LockContention,
+    LockOrder,
+)
+from rsprof.logutil import info, panic, warn
+from rsprof.proto import Event, ProfileBuilder
+from rsprof.samplingutil import Sampling, scale_metrics
+from rsprof.stackutil import RawStackTrace, StackFrame, StackTable, StackTrace
+
+# group-by of allocations is vectorised if numpy is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# record kinds counted as allocations by each module
+ALLOCATION_KINDS: Dict[str, Tuple[int, ...]] = {
+    "memory": (ALLOC, REALLOC),
+    "memtrace": (ALLOC,),
+}
+
+# upper bounds of the size classes of the allocation size histogram
+SIZE_CLASSES = (64, 1 << 10, 1 << 16)
+
+ALLOCATION_METRICS = (
+    ("bytes", "allocation size"),
+    ("bytes", "allocation align"),
+    ("count", "allocation count"),
+    ("bytes", "max allocation size", max),
+    ("count", "allocations of up to 64 bytes"),
+    ("count", "allocations of up to 1 KiB"),
+    ("count", "allocations of up to 64 KiB"),
+    ("count", "allocations of more than 64 KiB"),
+)
+
+# memory still held at the end of tracing, and at the peak of the live heap,
+# by the allocating call stack
+LIVE_HEAP_METRICS = (
+    ("bytes", "live bytes at exit"),
+    ("count", "live allocations at exit"),
+    ("bytes", "live bytes at peak"),
+)
+
+# lifetime classes of freed allocations, by time and by the events in between
+# the allocation and the deallocation, see heaputil.LIFETIME_*_BOUNDS
+LIFETIME_METRICS = (
+    ("count", "lifetime of up to 1 us"),
+    ("count", "lifetime of up to 10 us"),
+    ("count", "lifetime of up to 100 us"),
+    ("count", "lifetime of up to 1 ms"),
+    ("count", "lifetime of up to 10 ms"),
+    ("count", "lifetime of more than 10 ms"),
+    ("count", "lifetime of up to 10 events"),
+    ("count", "lifetime of up to 100 events"),
+    ("count", "lifetime of up to 1000 events"),
+    ("count", "lifetime of up to 10000 events"),
+    ("count", "lifetime of more than 10000 events"),
+)
+
+# allocation sites listed for each bucket of the heap timeline
+TIMELINE_TOP_SITES = 5
+
+# statistics of each acquiring call site, see lockutil
+CONTENTION_METRICS = (
+    ("count", "acquisitions"),
+    ("count", "contended acquisitions"),
+    ("nanoseconds", "wait time"),
+    ("nanoseconds", "max wait time", max),
+    ("nanoseconds", "hold time"),
+    ("nanoseconds", "max hold time", max),
+)
+
+# mutexes listed by the summary of the contention report
+CONTENTION_TOP_MUTEXES = 10
+
+# frames of the locking libraries, skipped when naming a call site
+LOCK_LIBRARY_PREFIXES = ("std::", "<std::", "core::", "lock_api::", "parking_lot::")
+
+# samples of each call stack of the cpu module, and the cpu time used by the
+# threads in between their samples
+CPU_METRICS = (
+    ("count", "samples"),
+    ("nanoseconds", "cpu time"),
+)
+
+# logs shorter than this many records per worker are not worth a process
+MIN_SHARD_RECORDS = 1 << 16
+
+
+class StackScales:
+    # factors of the metrics of each call stack of sampled events, from the
+    # mean size of the sampled allocations of the stack whose address is
+    # known, as in LiveHeap.allocated or fold_allocated, so that all of the
+    # reports of the same events scale a stack alike
+    def __init__(self, sampling: Sampling, allocated: Dict[int, List[int]]) -> None:
+        self.sampling = sampling
+        self.allocated = allocated
+
+    def __call__(self, stack: int, count: int, size: int) -> float:
+        # count and size are the ones of the report, for a stack of which no
+        # block is in the heap, e.g. allocations whose address was not caught
+        allocated = self.allocated.get(stack)
+        if allocated is not None:
+            count, size = allocated
+        return self.sampling.scale(count, size)
+
+    def total(self) -> float:
+        # factor of the whole heap, for the metrics of no particular stack
+        count = sum(allocated[0] for allocated in self.allocated.values())
+        size = sum(allocated[1] for allocated in self.allocated.values())
+        return self.sampling.scale(count, size)
+
+
+class OfflineSymbolizer:
+    def __init__(self, symbols: Dict[int, List[StackFrame]]) -> None:
+        self.symbols = symbols
+
+    def symbolize_address(self, address: int) -> List[StackFrame]:
+        frames = self.symbols.get(address)
+        if frames is None:
+            # not resolved before the session ended, keep the bare address
+            frame = StackFrame(f"0x{address:x}", "", "", 0)
+            frame.name = frame.system_name
+            frames = [frame]
+            self.symbols[address] = frames
+        return frames
+
+    def symbolize(self, rawtrace: RawStackTrace) -> StackTrace:
+        frames = []
+        for pc in rawtrace.pcs:
+            frames.extend(self.symbolize_address(pc))
+        return StackTrace(rawtrace.thread_id, frames)
+
+
+def _fold_allocations_python(
+    chunks: Iterable[Columns], kinds: Tuple[int, ...]
+) -> Dict[int, List[int]]:
+    folded: Dict[int, List[int]] = {}
+    for columns in chunks:
+        for kind, size, align, stack in zip(
+            columns[KIND], columns[SIZE], columns[ALIGN], columns[STACK]
+        ):
+            if kind in kinds:
+                metric = folded.get(stack)
+                if metric is None:
+                    metric = [0] * len(ALLOCATION_METRICS)
+                    folded[stack] = metric
+                metric[0] += size
+                metric[1] += align
+                metric[2] += 1
+                if size > metric[3]:
+                    metric[3] = size
+                metric[4 + bisect_left(SIZE_CLASSES, size)] += 1
+    return folded
+
+
+def _fold_allocations_numpy(
+    chunks: Iterable[Columns], kinds: Tuple[int, ...]
+) -> Dict[int, List[int]]:
+    # stack ids are indexes of the stack table, so the metrics of each chunk
+    # are reduced with bincount into arrays indexed by stack id
+    classes = len(SIZE_CLASSES) + 1
+    size_classes = numpy.array(SIZE_CLASSES, dtype=numpy.uint64)
+    sizes, aligns, counts, peaks = (numpy.zeros(0, numpy.uint64) for _ in range(4))
+    histograms = numpy.zeros((0, classes), numpy.uint64)
+    # position of the first allocation of each stack
+    firsts = numpy.zeros(0, numpy.int64)
+
+    position = 0
+    for columns in chunks:
+        kind, size, align, stack = (
+            numpy.frombuffer(columns[field], dtype=numpy.uint64)
+            for field in (KIND, SIZE, ALIGN, STACK)
+        )
+        (selected,) = numpy.nonzero(numpy.isin(kind, kinds))
+        selected_position = selected + position
+        position += len(kind)
+        if len(selected) == 0:
+            continue
+        size, align = size[selected], align[selected]
+        stack = stack[selected].astype(numpy.intp)
+
+        length = int(stack.max()) + 1
+        if length > len(sizes):
+            extra = length - len(sizes)
+            sizes, aligns, counts, peaks = (
+                numpy.concatenate((column, numpy.zeros(extra, numpy.uint64)))
+                for column in (sizes, aligns, counts, peaks)
+            )
+            histograms = numpy.concatenate(
+                (histograms, numpy.zeros((extra, classes), numpy.uint64))
+            )
+            firsts = numpy.concatenate(
+                (firsts, numpy.full(extra, numpy.iinfo(numpy.int64).max))
+            )
+
+        # weights are summed as float64, exact for the sums of a chunk
+        sizes[:length] += numpy.bincount(stack, size, length).astype(numpy.uint64)
+        aligns[:length] += numpy.bincount(stack, align, length).astype(numpy.uint64)
+        counts[:length] += numpy.bincount(stack, minlength=length).astype(numpy.uint64)
+        numpy.maximum.at(peaks, stack, size)
+        size_class = numpy.searchsorted(size_classes, size, side="left")
+        histograms[:length] += (
+            numpy.bincount(stack * classes + size_class, minlength=length * classes)
+            .reshape(length, classes)
+            .astype(numpy.uint64)
+        )
+        stacks, index = numpy.unique(stack, return_index=True)
+        firsts[stacks] = numpy.minimum(firsts[stacks], selected_position[index])
+
+    # stacks are visited in the order of their first allocation, as in the
+    # python version
+    (present,) = numpy.nonzero(counts)
+    present = present[numpy.argsort(firsts[present], kind="stable")]
+    folded: Dict[int, List[int]] = {}
+    for stack, size, align, count, peak, histogram in zip(
+        present.tolist(),
+        sizes[present].tolist(),
+        aligns[present].tolist(),
+        counts[present].tolist(),
+        peaks[present].tolist(),
+        histograms[present].tolist(),
+    ):
+        folded[stack] = [size, align, count, peak, *histogram]
+    return folded
+
+
+def fold_allocations(
+    chunks: Iterable[Columns], kinds: Tuple[int, ...]
+) -> Dict[int, List[int]]:
+    # metrics of ALLOCATION_METRICS per stack id, so that each distinct stack
+    # is symbolized and walked into the calling context tree once
+    if numpy is None:
+        return _fold_allocations_python(chunks, kinds)
+    return _fold_allocations_numpy(chunks, kinds)
+
+
+def fold_allocated(chunks: Iterable[Columns]) -> Dict[int, List[int]]:
+    # blocks and bytes allocated by each stack, the same as LiveHeap.allocated
+    # without replaying the heap
+    kinds = (ALLOC, REALLOC)
+    folded: Dict[int, List[int]] = {}
+    for columns in chunks:
+        if numpy is None:
+            for kind, size, addr, stack in zip(
+                columns[KIND], columns[SIZE], columns[ADDR], columns[STACK]
+            ):
+                if kind in kinds and addr != 0:
+                    allocated = folded.get(stack)
+                    if allocated is None:
+                        folded[stack] = [1, size]
+                    else:
+                        allocated[0] += 1
+                        allocated[1] += size
+            continue
+        kind, size, addr, stack = (
+            numpy.frombuffer(columns[field], dtype=numpy.uint64)
+            for field in (KIND, SIZE, ADDR, STACK)
+        )
+        (selected,) = numpy.nonzero(numpy.isin(kind, kinds) & (addr != 0))
+        stacks, inverse, counts = numpy.unique(
+            stack[selected], return_inverse=True, return_counts=True
+        )
+        # weights are summed as float64, exact for the sums of a chunk
+        sizes = numpy.bincount(inverse, size[selected], len(stacks)).astype(
+            numpy.uint64
+        )
+        for stack_id, count, total in zip(
+            stacks.tolist(), counts.tolist(), sizes.tolist()
+        ):
+            allocated = folded.get(stack_id)
+            if allocated is None:
+                folded[stack_id] = [count, total]
+            else:
+                allocated[0] += count
+                allocated[1] += total
+    return folded
+
+
+def add_lifetimes(
+    profile_builder: ProfileBuilder,
+    lifetimes: Lifetimes,
+    stacktrace: Callable[[int], StackTrace],
+    scales: Optional[StackScales] = None,
+):
+    # LIFETIME_METRICS are the last metrics of the builder, the histograms
+    # are summed into the contexts of the allocating stacks
+    padding = [0] * (len(profile_builder.metric_type) - len(LIFETIME_METRICS))
+    for stack, histogram in lifetimes.histograms.items():
+        if scales is not None:
+            histogram = scale_metrics(histogram, scales(stack, 0, 0))
+        profile_builder.add_event(Event(stacktrace(stack), padding + histogram))
+
+
+def build_allocations(
+    folded: Dict[int, List[int]],
+    stacktrace: Callable[[int], StackTrace],
+    lifetimes: Optional[Lifetimes] = None,
+    scales: Optional[StackScales] = None,
+) -> ProfileBuilder:
+    if lifetimes is None:
+        profile_builder = ProfileBuilder(*ALLOCATION_METRICS)
+        padding = []
+    else:
+        profile_builder = ProfileBuilder(*ALLOCATION_METRICS, *LIFETIME_METRICS)
+        padding = [0] * len(LIFETIME_METRICS)
+    for stack, metric in folded.items():
+        if scales is not None:
+            # the max allocation size is exact
+            metric = scale_metrics(metric, scales(stack, metric[2], metric[0]), (3,))
+        profile_builder.add_event(Event(stacktrace(stack), metric + padding))
+    if lifetimes is not None:
+        add_lifetimes(profile_builder, lifetimes, stacktrace, scales)
+    return profile_builder
+
+
+def report_allocations(
+    chunks: Iterable[Columns],
+    kinds: Tuple[int, ...],
+    stacktrace: Callable[[int], StackTrace],
+    filename: str,
+    lifetimes: Optional[Lifetimes] = None,
+    scales: Optional[StackScales] = None,
+):
+    build_allocations(
+        fold_allocations(chunks, kinds), stacktrace, lifetimes, scales
+    ).write_file(filename)
+
+
+def build_live_heap(
+    heap: LiveHeap,
+    stacktrace: Callable[[int], StackTrace],
+    scales: Optional[StackScales] = None,
+) -> ProfileBuilder:
+    profile_builder = ProfileBuilder(*LIVE_HEAP_METRICS)
+    for stack, size, blocks, at_peak in heap.stacks():
+        metric = [size, blocks, at_peak]
+        if scales is not None:
+            metric = scale_metrics(metric, scales(stack, blocks, size))
+        profile_builder.add_event(Event(stacktrace(stack), metric))
+    return profile_builder
+
+
+def write_timeline(
+    timeline: HeapTimeline,
+    stacktrace: Callable[[int], StackTrace],
+    filename: str,
+    scale: float = 1.0,
+):
+    # sites are named by the functions of their stack, innermost first, and
+    # bytes of sampled events are scaled by the factor of the whole heap
+    def site(stack: int):
+        return [frame.name for frame in stacktrace(stack).frames]
+
+    def estimate(size: int):
+        return size if scale == 1.0 else round(size * scale)
+
+    with open(filename, "w") as f:
+        json.dump(
+            {
+                "start_ns": timeline.start,
+                "bucket_ns": timeline.width,
+                "buckets": [
+                    {
+                        "start_ns": index * timeline.width,
+                        "live_bytes_min": estimate(bucket.live_min),
+                        "live_bytes_max": estimate(bucket.live_max),
+                        "live_bytes": estimate(bucket.live_end),
+                        "allocated_bytes": estimate(bucket.allocated),
+                        "top_sites": [
+                            {"stack": site(stack), "allocated_bytes": estimate(size)}
+                            for stack, size in bucket.top_sites(TIMELINE_TOP_SITES)
+                        ],
+                    }
+                    for index, bucket in enumerate(timeline.buckets)
+                ],
+            },
+            f,
+        )
+
+
+def report_heap(
+    records: Iterable[EventRecord],
+    stacktrace: Callable[[int], StackTrace],
+    prefix: str,
+    scales: Optional[StackScales] = None,
+) -> Lifetimes:
+    # the live heap, its timeline and lifetimes depend on the order of
+    # events, they are replayed in order
+    heap = LiveHeap()
+    timeline = HeapTimeline()
+    lifetimes = Lifetimes()
+    for record in records:
+        heap.update(record)
+        timeline.update(record, heap.live_bytes)
+        lifetimes.update(record)
+    build_live_heap(heap, stacktrace, scales).write_file(f"{prefix}.live.prof")
+    write_timeline(
+        timeline,
+        stacktrace,
+        f"{prefix}.timeline.json",
+        1.0 if scales is None else scales.total(),
+    )
+    return lifetimes
+
+
+def build_contention(
+    contention: LockContention, stacktrace: Callable[[int], StackTrace]
+) -> ProfileBuilder:
+    profile_builder = ProfileBuilder(*CONTENTION_METRICS)
+    for stack, statistics in contention.sites.items():
+        profile_builder.add_event(Event(stacktrace(stack), statistics))
+    return profile_builder
+
+
+def _format_ns(nanoseconds: int) -> str:
+    for unit, scale in (("s", 10**9), ("ms", 10**6), ("us", 10**3)):
+        if nanoseconds >= scale:
+            return f"{nanoseconds / scale:.3g} {unit}"
+    return f"{nanoseconds} ns"
+
+
+def _lock_site(stacktrace: StackTrace) -> str:
+    # innermost function out of the locking libraries
+    frames = stacktrace.frames
+    return next(
+        (f.name for f in frames if not f.name.startswith(LOCK_LIBRARY_PREFIXES)),
+        frames[0].name if len(frames) != 0 else "?",
+    )
+
+
+def contention_summary(
+    contention: LockContention, stacktrace: Callable[[int], StackTrace], count: int
+) -> List[str]:
+    # one line for each of the most contended mutexes
+    lines = []
+    for mutex, statistics in contention.top_mutexes(count):
+        site = _lock_site(stacktrace(contention.worst_site(mutex)))
+        lines.append(
+            f"mutex 0x{mutex:x}: {statistics[ACQUISITIONS]} acquisitions, "
+            f"{statistics[CONTENTIONS]} contended, "
+            f"waited {_format_ns(statistics[WAIT_TIME])} "
+            f"(max {_format_ns(statistics[MAX_WAIT_TIME])}), "
+            f"held {_format_ns(statistics[HOLD_TIME])} "
+            f"(max {_format_ns(statistics[MAX_HOLD_TIME])}), "
+            f"longest waits at {site}"
+        )
+    return lines
+
+
+def write_lock_cycles(
+    order: LockOrder, stacktrace: Callable[[int], StackTrace], filename: str
+):
+    # each edge of a cycle comes with the stacks locking both of its mutexes
+    def frames(stack: int):
+        return [frame.serialize() for frame in stacktrace(stack).frames]
+
+    with open(filename, "w") as f:
+        json.dump(
+            {
+                "cycles": [
+                    [
+                        {
+                            "held": f"0x{edge.held:x}",
+                            "acquired": f"0x{edge.acquired:x}",
+                            "thread_id": edge.thread,
+                            "held_stack": frames(edge.held_stack),
+                            "acquired_stack": frames(edge.acquired_stack),
+                        }
+                        for edge in cycle
+                    ]
+                    for cycle in order.cycles
+                ]
+            },
+            f,
+        )
+
+
+def lock_cycle_summary(
+    order: LockOrder, stacktrace: Callable[[int], StackTrace]
+) -> List[str]:
+    # one line for each cycle, with the call sites of its edges
+    return [
+        "potential deadlock: "
+        + ", ".join(
+            f"0x{edge.acquired:x} locked at "
+            f"{_lock_site(stacktrace(edge.acquired_stack))} while holding "
+            f"0x{edge.held:x} locked at {_lock_site(stacktrace(edge.held_stack))}"
+            for edge in cycle
+        )
+        for cycle in order.cycles
+    ]
+
+
+def report_locks(
+    records: Iterable[EventRecord], stacktrace: Callable[[int], StackTrace], prefix: str
+):
+    contention = LockContention()
+    order = LockOrder()
+    for record in records:
+        contention.update(record)
+        order.update(record)
+    build_contention(contention, stacktrace).write_file(f"{prefix}.prof")
+    write_lock_cycles(order, stacktrace, f"{prefix}.lockorder.json")
+    for line in contention_summary(contention, stacktrace, CONTENTION_TOP_MUTEXES):
+        info(line)
+    for line in lock_cycle_summary(order, stacktrace):
+        warn(line)
+
+
+def fold_samples(chunks: Iterable[Columns]) -> Dict[int, List[int]]:
+    # samples and cpu time of each stack
+    folded: Dict[int, List[int]] = {}
+    for chunk in chunks:
+        for kind, cpu_time, stack in zip(chunk[KIND], chunk[SIZE], chunk[STACK]):
+            if kind != CPU_SAMPLE:
+                continue
+            metrics = folded.get(stack)
+            if metrics is None:
+                folded[stack] = [1, cpu_time]
+            else:
+                metrics[0] += 1
+                metrics[1] += cpu_time
+    return folded
+
+
+def report_samples(
+    chunks: Iterable[Columns],
+    stacktrace: Callable[[int], StackTrace],
+    filename: str,
+):
+    profile_builder = ProfileBuilder(*CPU_METRICS)
+    for stack, metrics in fold_samples(chunks).items():
+        profile_builder.add_event(Event(stacktrace(stack), metrics))
+    profile_builder.write_file(filename)
+
+
+# state of a worker process of the parallel report, loaded once per worker
+_shard_stacks: Optional[StackTable] = None
+_shard_symbolizer: Optional[OfflineSymbolizer] = None
+
+
+def _load_symbolizer(path: str) -> OfflineSymbolizer:
+    if os.path.exists(symbols_path(path)):
+        return OfflineSymbolizer(read_symbols(path))
+    return OfflineSymbolizer({})
+
+
+def _init_shard_worker(path: str):
+    global _shard_stacks, _shard_symbolizer
+    _shard_stacks = read_stacks(path)
+    _shard_symbolizer = _load_symbolizer(path)
+
+
+def _shard_stacktrace(stack: int) -> StackTrace:
+    assert _shard_stacks is not None and _shard_symbolizer is not None
+    # a stack missing from the log of a crashed session is left empty
+    pcs = _shard_stacks[stack] if stack < len(_shard_stacks) else ()
+    return _shard_symbolizer.symbolize(RawStackTrace(0, pcs))
+
+
+def _report_shard(
+    shard: Tuple[str, Tuple[int, ...], int, int, bool, Optional[StackScales]]
+) -> ProfileBuilder:
+    path, kinds, start, count, with_lifetimes, scales = shard
+    # lifetimes are added once by the caller, shards only make room for them
+    return build_allocations(
+        fold_allocations(read_record_columns(path, start, count), kinds),
+        _shard_stacktrace,
+        Lifetimes() if with_lifetimes else None,
+        scales,
+    )
+
+
+def report_allocations_parallel(
+    path: str,
+    kinds: Tuple[int, ...],
+    filename: str,
+    jobs: int,
+    replay: Optional[Callable[[], Lifetimes]] = None,
+    scales: Optional[StackScales] = None,
+):
+    # the log is cut into contiguous shards of records, every worker builds
+    # the partial calling context tree of its shard and the trees are merged,
+    # replay is run in this process while the workers fold and its lifetimes
+    # are added to the merged tree
+    count = record_count(path)
+    shards = max(1, min(jobs, count // MIN_SHARD_RECORDS))
+    with_lifetimes = replay is not None
+    _init_shard_worker(path)
+    if shards == 1:
+        profile_builder = _report_shard(
+            (path, kinds, 0, count, with_lifetimes, scales)
+        )
+        lifetimes = None if replay is None else replay()
+        if lifetimes is not None:
+            add_lifetimes(profile_builder, lifetimes, _shard_stacktrace, scales)
+        profile_builder.write_file(filename)
+        return
+
+    bounds = [count * i // shards for i in range(0, shards + 1)]
+    with ProcessPoolExecutor(
+        max_workers=shards, initializer=_init_shard_worker, initargs=(path,)
+    ) as executor:
+        partials = [
+            executor.submit(
+                _report_shard,
+                (
+                    path,
+                    kinds,
+                    bounds[i],
+                    bounds[i + 1] - bounds[i],
+                    with_lifetimes,
+                    scales,
+                ),
+            )
+            for i in range(0, shards)
+        ]
+        lifetimes = None if replay is None else replay()
+        profile_builder: Optional[ProfileBuilder] = None
+        for future in partials:
+            partial = future.result()
+            if profile_builder is None:
+                profile_builder = partial
+            else:
+                profile_builder.merge(partial)
+    assert profile_builder is not None
+    if lifetimes is not None:
+        add_lifetimes(profile_builder, lifetimes, _shard_stacktrace, scales)
+    profile_builder.write_file(filename)
+
+
+def _module_of_log(path: str) -> Optional[str]:
+    # logs are named {prefix}.{module}.log
+    parts = os.path.basename(path).split(".")
+    if len(parts) >= 2 and parts[-1] == "log":
+        return parts[-2]
+    return None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = ArgumentParser(
+        prog="python -m rsprof.report",
+        description="generate the report of an event log outside of lldb",
+    )
+    parser.add_argument("log", type=str, help="event log written by rsprof")
+    parser.add_argument(
+        "-m", "--module", type=str, help="tracing module of the log, from its name"
+    )
+    parser.add_argument("-o", "--output", type=str, help="output report file")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes, defaults to the number of cpus",
+    )
+    args = parser.parse_args(argv)
+
+    # the records and their stacks are needed, the symbols of a log which was
+    # never dumped, e.g. the one of a crashed session, are not
+    for path in (args.log, stacks_path(args.log)):
+        if not os.path.isfile(path):
+            parser.error(f"'{path}' does not exist")
+    if not os.path.exists(symbols_path(args.log)):
+        warn(f"no symbols for '{args.log}', call stacks are reported as addresses")
+
+    module = args.module if args.module is not None else _module_of_log(args.log)
+    if module not in ALLOCATION_KINDS and module not in ("mutex", "cpu"):
+        panic(f"unable to report tracing module '{module}' offline")
+
+    prefix = module if args.output is None else f"{args.output}.{module}"
+
+    if module == "mutex":
+        _init_shard_worker(args.log)
+        report_locks(read_records(args.log), _shard_stacktrace, prefix)
+        info(f"report of '{args.log}' is written to '{prefix}.prof'")
+        return
+    if module == "cpu":
+        _init_shard_worker(args.log)
+        report_samples(
+            read_record_columns(args.log), _shard_stacktrace, f"{prefix}.prof"
+        )
+        info(f"report of '{args.log}' is written to '{prefix}.prof'")
+        return
+
+    sampling = read_sampling(args.log)
+    scales = None
+    if sampling is not None:
+        scales = StackScales(
+            Sampling.parse(sampling), fold_allocated(read_record_columns(args.log))
+        )
+
+    # the live heap is replayed while the workers build the allocation profile
+    def replay() -> Lifetimes:
+        lifetimes = report_heap(
+            read_records(args.log), _shard_stacktrace, prefix, scales
+        )
+        info(f"live heap of '{args.log}' is written to '{prefix}.live.prof'")
+        info(f"heap timeline of '{args.log}' is written to '{prefix}.timeline.json'")
+        return lifetimes
+
+    filename = f"{prefix}.prof"
+    report_allocations_parallel(
+        args.log,
+        ALLOCATION_KINDS[module],
+        filename,
+        max(1, args.jobs),
+        replay,
+        scales,
+    )
+    info(f"report of '{args.log}' is written to '{filename}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# sampling of tracing events, given as `--sample 1/N` for one event in N on
+# average, or as a size such as `--sample 512KiB` for one sample per that many
+# bytes allocated on average (a Poisson process over the allocated bytes, so
+# large allocations are sampled more often than small ones)
+#
+# metrics of sampled events are scaled back by the inverse of the probability
+# of sampling, which makes them unbiased estimates of the complete ones
+
+from math import ceil, expm1, log
+import random
+import re
+from typing import Collection, List
+
+# sizes are in bytes, or in binary multiples: 512K, 512KB and 512KiB are all
+# 512 * 1024 bytes
+_SIZE = re.compile(r"^(\d+)\s*(?:([kmg])i?)?b?$", re.IGNORECASE)
+_UNITS = {None: 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+
+
+class Sampling:
+    def __init__(self, period: int, by_bytes: bool) -> None:
+        # mean number of events, or of bytes, in between two samples
+        self.period = period
+        self.by_bytes = by_bytes
+        # bytes left before the next sample, see sample
+        self.remaining = self._draw_bytes()
+
+    @staticmethod
+    def parse(text: str) -> "Sampling":
+        text = text.strip()
+        if text.startswith("1/"):
+            period = int(text[2:])
+            if period < 1:
+                raise ValueError(f"invalid sampling rate '{text}'")
+            return Sampling(period, False)
+        match = _SIZE.match(text)
+        if match is None or int(match.group(1)) == 0:
+            raise ValueError(f"invalid sampling rate '{text}'")
+        unit = match.group(2)
+        return Sampling(
+            int(match.group(1)) * _UNITS[None if unit is None else unit.lower()], True
+        )
+
+    def __str__(self) -> str:
+        # also the format read by rsprof-stub from RSPROF_SAMPLE
+        return f"{self.period}B" if self.by_bytes else f"1/{self.period}"
+
+    def probability(self, size: int) -> float:
+        # probability that an event, of an allocation of size bytes, is sampled
+        if self.by_bytes:
+            return -expm1(-size / self.period)
+        return 1 / self.period
+
+    def scale(self, count: int, size: int) -> float:
+        # factor of the metrics of a call stack with count sampled events of
+        # size bytes in total, from the mean size of its events in byte mode
+        # as samples of a call stack tend to be of the same size
+        if count == 0:
+            return 1.0
+        return 1 / self.probability(size / count)
+
+    def skip(self) -> int:
+        # events to skip before the next sample, geometric so that each event
+        # is sampled with probability 1 / period, for breakpoint ignore counts
+        if self.period == 1:
+            return 0
+        return int(log(1.0 - random.random()) / log(1.0 - 1.0 / self.period))
+
+    def _draw_bytes(self) -> int:
+        return ceil(random.expovariate(1.0 / self.period))
+
+    def sample(self, size: int) -> bool:
+        # whether an event of size bytes is sampled, decided by the debugger
+        if not self.by_bytes:
+            return random.random() * self.period < 1
+        if size < self.remaining:
+            self.remaining -= size
+            return False
+        # the process is memoryless, the next sample is drawn afresh
+        self.remaining = self._draw_bytes()
+        return True
+
+
+def scale_metrics(
+    metrics: List[int], factor: float, exact: Collection[int] = ()
+) -> List[int]:
+    # metrics of a call stack scaled to estimates, but for the ones in exact,
+    # e.g. maximums, which are not sums of events
+    return [
+        metric if index in exact else round(metric * factor)
+        for index, metric in enumerate(metrics)
+    ]
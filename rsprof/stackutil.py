@@ -0,0 +1,94 @@
+# data types of call stacks, independent of lldb so that reports could be
+# generated outside of the debugger
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from rsprof.demangleutil import DemangleCache, demangle
+
+
+@dataclass
+class StackFrame:
+    __slots__ = ("system_name", "path", "file", "line", "name")
+
+    system_name: str
+    path: str
+    file: str
+    line: int
+
+    def resolve(self, cache: Optional[DemangleCache] = None):
+        if cache is None:
+            self.name = demangle(self.system_name)
+        else:
+            self.name = cache.demangle(self.system_name)
+
+    def serialize(self):
+        return {
+            "system_name": self.system_name,
+            "name": self.name,
+            "path": self.path,
+            "file": self.file,
+            "line": self.line,
+        }
+
+
+@dataclass
+class StackTrace:
+    thread_id: int
+    frames: List[StackFrame]
+
+    def resolve(self):
+        for st in self.frames:
+            st.resolve()
+
+    def filter_module(self, module_prefix: str):
+        self.frames = list(
+            filter(lambda x: x.system_name.startswith(module_prefix), self.frames)
+        )
+
+    def __getitem__(self, key: int):
+        return self.frames[key]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def serialize(self):
+        return {
+            "thread_id": self.thread_id,
+            "frames": list(map(lambda x: x.serialize(), self.frames)),
+        }
+
+
+@dataclass
+class RawStackTrace:
+    thread_id: int
+    # lookup addresses of the frames, innermost first
+    pcs: Tuple[int, ...]
+
+    def __len__(self):
+        return len(self.pcs)
+
+
+class StackTable:
+    def __init__(self) -> None:
+        # stack ids are indexes into the table of distinct pc tuples
+        self.alloca_table: Dict[Tuple[int, ...], int] = {}
+        self.elemen_table: List[Tuple[int, ...]] = []
+
+    def intern(self, pcs: Tuple[int, ...]) -> int:
+        stack_id = self.alloca_table.get(pcs)
+        if stack_id is None:
+            stack_id = len(self.elemen_table)
+            self.alloca_table[pcs] = stack_id
+            self.elemen_table.append(pcs)
+        return stack_id
+
+    def __getitem__(self, stack_id: int) -> Tuple[int, ...]:
+        return self.elemen_table[stack_id]
+
+    def __len__(self):
+        return len(self.elemen_table)
+
+    def clear(self):
+        self.alloca_table.clear()
+        self.elemen_table.clear()
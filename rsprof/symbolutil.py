@@ -0,0 +1,135 @@
+# symbol index of modules, built once per module UUID (build id) from the
+# symbol table and kept on disk so that later sessions never walk SBSymbols
+
+from array import array
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional
+from lldb import SBModule, SBSymbol, SBTarget
+
+from rsprof.demangleutil import CACHE_DIR, demangle_cache
+from rsprof.logutil import warn
+
+# file address of symbols without a section, e.g. undefined ones
+INVALID_ADDRESS = 0xFFFFFFFFFFFFFFFF
+
+_MAGIC = b"RSPSYM1\n"
+# symbol count, whether the demangled names are present
+_HEADER = struct.Struct("<QQ")
+
+
+def _not_none(s: Optional[str]):
+    return "" if s is None else s
+
+
+class SymbolIndex:
+    def __init__(self, uuid: str, path: str) -> None:
+        self.uuid = uuid
+        self.path = path
+        self.names: List[str] = []
+        # empty if the symbol is not mangled
+        self.mangled_names: List[str] = []
+        # demangled names are only computed when asked for
+        self.demangled_names: Optional[List[str]] = None
+        self.addresses = array("Q")
+
+    def __len__(self):
+        return len(self.names)
+
+    def sysname(self, index: int):
+        mangled_name = self.mangled_names[index]
+        return self.names[index] if mangled_name == "" else mangled_name
+
+    def demangled(self) -> List[str]:
+        if self.demangled_names is None:
+            cache = demangle_cache(self.uuid)
+            self.demangled_names = [
+                cache.demangle(self.sysname(index)) for index in range(0, len(self))
+            ]
+            cache.save()
+            self.save()
+        return self.demangled_names
+
+    @property
+    def cache_path(self):
+        if self.uuid == "":
+            return None
+        return os.path.join(CACHE_DIR, f"symbols-{self.uuid}.idx")
+
+    def build(self, module: SBModule):
+        for si in range(0, module.GetNumSymbols()):
+            symbol: SBSymbol = module.GetSymbolAtIndex(si)
+            self.names.append(_not_none(symbol.GetName()))
+            self.mangled_names.append(_not_none(symbol.GetMangledName()))
+            address = symbol.GetStartAddress()
+            self.addresses.append(
+                address.GetFileAddress() if address.IsValid() else INVALID_ADDRESS
+            )
+        return self
+
+    def save(self):
+        path = self.cache_path
+        if path is None:
+            return
+        # names are NUL separated, as symbols could not contain NUL
+        columns = [self.names, self.mangled_names]
+        if self.demangled_names is not None:
+            columns.append(self.demangled_names)
+        strings = "\0".join("\0".join(column) for column in columns)
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(_MAGIC)
+            f.write(_HEADER.pack(len(self), len(columns)))
+            f.write(self.addresses.tobytes())
+            f.write(zlib.compress(strings.encode("utf-8")))
+        os.replace(temp_path, path)
+
+    def load(self) -> bool:
+        path = self.cache_path
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(_MAGIC)) != _MAGIC:
+                    raise ValueError("bad magic")
+                count, ncolumns = _HEADER.unpack(f.read(_HEADER.size))
+                self.addresses = array("Q")
+                self.addresses.frombytes(f.read(count * self.addresses.itemsize))
+                strings = zlib.decompress(f.read()).decode("utf-8").split("\0")
+        except (OSError, ValueError, struct.error, zlib.error):
+            warn(f"ignore broken symbol index '{path}'")
+            return False
+
+        if count == 0:
+            return True
+        self.names = strings[0:count]
+        self.mangled_names = strings[count: 2 * count]
+        if ncolumns > 2:
+            self.demangled_names = strings[2 * count: 3 * count]
+        return True
+
+
+_symbol_indexes: Dict[str, SymbolIndex] = {}
+
+
+def symbol_index(module: SBModule) -> SymbolIndex:
+    uuid = _not_none(module.GetUUIDString())
+    path = module.GetFileSpec().fullpath
+    # modules without uuid are only indexed for the session
+    key = uuid if uuid != "" else _not_none(path)
+    index = _symbol_indexes.get(key)
+    if index is None:
+        index = SymbolIndex(uuid, _not_none(path))
+        if not index.load():
+            index.build(module).save()
+        _symbol_indexes[key] = index
+    return index
+
+
+def target_symbol_indexes(target: SBTarget):
+    for i in range(0, target.GetNumModules()):
+        module: SBModule = target.GetModuleAtIndex(i)
+        yield module, symbol_index(module)
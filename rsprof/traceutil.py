@@ -1,30 +1,24 @@
-from dataclasses import dataclass
-from typing import List
-from lldb import SBFrame, SBLineEntry, SBFileSpec, SBThread, SBFunction
-from rust_demangler import demangle
-
-
-@dataclass
-class StackFrame:
-    system_name: str
-    path: str
-    file: str
-    line: int
-
-    def resolve(self):
-        try:
-            self.name = demangle(self.system_name)
-        except:
-            self.name = self.system_name
-
-    def serialize(self):
-        return {
-            "system_name": self.system_name,
-            "name": self.name,
-            "path": self.path,
-            "file": self.file,
-            "line": self.line,
-        }
+from typing import Dict, List, Optional, Tuple
+from lldb import (
+    SBAddress,
+    SBBlock,
+    SBError,
+    SBFrame,
+    SBLineEntry,
+    SBFileSpec,
+    SBProcess,
+    SBSymbolContext,
+    SBTarget,
+    SBThread,
+    SBFunction,
+    eSymbolContextEverything,
+)
+from rsprof.demangleutil import demangle_cache
+# plain data types of stacks, they do not depend on lldb
+from rsprof.stackutil import RawStackTrace, StackFrame, StackTable, StackTrace
+
+# call stacks of all events, events only keep the integer id of their stack
+STACKS = StackTable()
 
 
 def stackframe_from_sbframe(frame: SBFrame):
@@ -42,37 +36,172 @@ def stackframe_from_sbframe(frame: SBFrame):
     )
 
 
-@dataclass
-class StackTrace:
-    thread_id: int
-    frames: List[StackFrame]
+def stacktrace_from_sbframe(frame: SBFrame):
+    stacktrace = []
+    thread: SBThread = frame.GetThread()
+    while frame.IsValid():
+        stacktrace.append(stackframe_from_sbframe(frame))
+        frame = frame.get_parent_frame()
+    return StackTrace(thread.GetThreadID(), stacktrace)
 
-    def resolve(self):
-        for st in self.frames:
-            st.resolve()
 
-    def filter_module(self, module_prefix: str):
-        self.frames = list(
-            filter(lambda x: x.system_name.startswith(module_prefix), self.frames)
-        )
+class UnwindCache:
+    # frames of the last capture of a thread, the pc alone is not enough to
+    # tell two activations of a frame apart but (cfa, pc) is
+    __slots__ = ("keys", "pcs", "index")
 
-    def __getitem__(self, key: int):
-        return self.frames[key]
+    def __init__(self, keys: List[Tuple[int, int]], pcs: List[int]) -> None:
+        self.keys = keys
+        self.pcs = pcs
+        self.index = {key: depth for depth, key in enumerate(keys)}
 
-    def __len__(self):
-        return len(self.frames)
 
-    def serialize(self):
-        return {
-            "thread_id": self.thread_id,
-            "frames": list(map(lambda x: x.serialize(), self.frames)),
-        }
+# last capture of each (process, thread)
+_unwind_caches: Dict[Tuple[int, int], UnwindCache] = {}
 
 
-def stacktrace_from_sbframe(frame: SBFrame):
-    stacktrace = []
+def clear_unwind_caches():
+    _unwind_caches.clear()
+
+
+# offset below the cfa of a frame of the return address into its caller, only
+# on architectures whose calls push it: elsewhere it is saved wherever the
+# prologue of the callee puts it and captures are not reused
+RETURN_ADDRESS_SLOTS = {"x86_64": 8}
+
+
+def _return_address_slot(process: SBProcess) -> Optional[int]:
+    triple = process.GetTarget().GetTriple()
+    if triple is None:
+        return None
+    return RETURN_ADDRESS_SLOTS.get(triple.split("-")[0])
+
+
+def _stale_caller(
+    process: SBProcess, keys: List[Tuple[int, int]], depth: int, slot: int
+) -> Optional[int]:
+    # the callers of a frame found in the last capture are still the same
+    # activations if each of their return addresses is still in its slot, the
+    # frame alone may have been called again from another call site. Returns
+    # the depth of the first caller which is not, None if all of them are
+    error = SBError()
+    for caller in range(depth + 1, len(keys)):
+        address = process.ReadPointerFromMemory(keys[caller - 1][0] - slot, error)
+        if not error.Success() or address - 1 != keys[caller][1]:
+            return caller
+    return None
+
+
+def rawtrace_from_sbframe(frame: SBFrame):
+    # only capture program counters while the target is stopped, symbols are
+    # resolved later by a Symbolizer
+    pcs: List[int] = []
+    keys: List[Tuple[int, int]] = []
     thread: SBThread = frame.GetThread()
+    process: SBProcess = thread.GetProcess()
+    thread_key = (process.GetProcessID(), thread.GetThreadID())
+    slot = _return_address_slot(process)
+    previous = None if slot is None else _unwind_caches.get(thread_key)
+    # frames of the previous capture below a stale caller are not reused
+    stale = 0
     while frame.IsValid():
-        stacktrace.append(stackframe_from_sbframe(frame))
+        # inlined frames share the pc of their concrete frame, they are
+        # recovered from the inlined blocks at symbolization
+        if not frame.IsInlined():
+            # return addresses of callers point past the call instruction
+            pc = frame.GetPC() if len(pcs) == 0 else frame.GetPC() - 1
+            key = (frame.GetCFA(), pc)
+            keys.append(key)
+            pcs.append(pc)
+            depth = None if previous is None else previous.index.get(key)
+            if depth is not None and depth >= stale:
+                stale = _stale_caller(process, previous.keys, depth, slot)
+                if stale is None:
+                    # reuse the callers instead of unwinding to the root
+                    keys.extend(previous.keys[depth + 1 :])
+                    pcs.extend(previous.pcs[depth + 1 :])
+                    break
         frame = frame.get_parent_frame()
-    return StackTrace(thread.GetThreadID(), stacktrace)
+    _unwind_caches[thread_key] = UnwindCache(keys, pcs)
+    return RawStackTrace(thread_key[1], tuple(pcs))
+
+
+def stack_from_sbframe(frame: SBFrame) -> Tuple[int, int]:
+    # thread id and the interned stack id of the current stack
+    rawtrace = rawtrace_from_sbframe(frame)
+    return rawtrace.thread_id, STACKS.intern(rawtrace.pcs)
+
+
+def stackframes_from_address(target: SBTarget, address: int):
+    sbaddress: SBAddress = target.ResolveLoadAddress(address)
+    context: SBSymbolContext = target.ResolveSymbolContextForAddress(
+        sbaddress, eSymbolContextEverything
+    )
+
+    line_entry: SBLineEntry = context.GetLineEntry()
+    file_spec: SBFileSpec = line_entry.GetFileSpec()
+    path, file, line = (
+        file_spec.GetDirectory(),
+        file_spec.GetFilename(),
+        line_entry.GetLine(),
+    )
+
+    # innermost inlined function first, each one is located at the call site
+    # recorded by the block it is inlined into
+    frames: List[StackFrame] = []
+    block: SBBlock = context.GetBlock().GetContainingInlinedBlock()
+    while block.IsValid():
+        inlined_name = block.GetInlinedName()
+        frames.append(
+            StackFrame(
+                "" if inlined_name is None else inlined_name, path, file, line
+            )
+        )
+        call_site: SBFileSpec = block.GetInlinedCallSiteFile()
+        path, file, line = (
+            call_site.GetDirectory(),
+            call_site.GetFilename(),
+            block.GetInlinedCallSiteLine(),
+        )
+        block = block.GetParent().GetContainingInlinedBlock()
+
+    function: SBFunction = context.GetFunction()
+    if function.IsValid():
+        function_name = function.GetName()
+    else:
+        function_name = context.GetSymbol().GetName()
+    frames.append(
+        StackFrame("" if function_name is None else function_name, path, file, line)
+    )
+
+    cache = demangle_cache(context.GetModule().GetUUIDString())
+    for frame in frames:
+        frame.resolve(cache)
+    return frames
+
+
+class Symbolizer:
+    def __init__(self, target: SBTarget) -> None:
+        self.target = target
+        # each address is resolved once, and so is each distinct stack
+        self.address_cache: Dict[int, List[StackFrame]] = {}
+        self.stack_cache: Dict[int, List[StackFrame]] = {}
+
+    def symbolize_address(self, address: int) -> List[StackFrame]:
+        frames = self.address_cache.get(address)
+        if frames is None:
+            frames = stackframes_from_address(self.target, address)
+            self.address_cache[address] = frames
+        return frames
+
+    def symbolize(self, rawtrace: RawStackTrace) -> StackTrace:
+        return self.symbolize_stack(STACKS.intern(rawtrace.pcs), rawtrace.thread_id)
+
+    def symbolize_stack(self, stack: int, thread_id: int = 0) -> StackTrace:
+        frames = self.stack_cache.get(stack)
+        if frames is None:
+            frames = []
+            for pc in STACKS[stack]:
+                frames.extend(self.symbolize_address(pc))
+            self.stack_cache[stack] = frames
+        return StackTrace(thread_id, frames)
@@ -1,19 +1,104 @@
+from abc import ABC, abstractmethod
+from argparse import Namespace
 from importlib import import_module
-from typing import Any, Callable, List, Optional, TypeVar
-from lldb import SBDebugger, SBTarget, SBFrame, SBBreakpointLocation
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+from lldb import SBDebugger, SBTarget, SBFrame, SBBreakpointLocation, SBThread
 
+from rsprof.demangleutil import save_demangle_caches
+from rsprof.eventlog import (
+    Columns,
+    EventLog,
+    EventRecord,
+    EventStore,
+    read_record_columns,
+    read_records,
+    write_sampling,
+    write_symbols,
+)
 from rsprof.lldbutil import BreakpointManager
 from rsprof.logutil import fail, info, panic, warn
-from rsprof.traceutil import StackTrace
+from rsprof.samplingutil import Sampling
+from rsprof.traceutil import STACKS, Symbolizer, clear_unwind_caches
 
 _T = TypeVar("_T")
 
+# continuations of functions which have not returned yet, keyed by thread and
+# the CFA of the function, which is the stack pointer after it returned
+_returns: Dict[Tuple[int, int], Callable[[SBFrame], None]] = {}
+
+
+def function_return(
+    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
+):
+    continuation = _returns.pop((frame.GetThread().GetThreadID(), frame.GetSP()), None)
+    if continuation is not None:
+        continuation(frame)
+
+
+class Accumulator:
+    __slots__ = ("count", "total", "peak")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.peak = 0
+
+    def fold(self, value: int):
+        self.count += 1
+        self.total += value
+        if value > self.peak:
+            self.peak = value
+
 
 class TracingModule:
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, samplable: bool = False) -> None:
         self.breakpoints = BreakpointManager()
         self.name = name
-        self.events: List["TracingEvent"] = []
+        # events of the default mode, stored as columns of their records
+        self.events = EventStore()
+        # resolves raw stack traces against the reported target
+        self.symbolizer: Optional[Symbolizer] = None
+
+        # in aggregate mode events are folded into an accumulator per event
+        # type and call stack as they arrive, and then dropped
+        self.aggregate = False
+        self.aggregates: Dict[Tuple[Type["TracingEvent"], int], Accumulator] = {}
+
+        # otherwise events are appended to an event log on disk if given
+        self.log: Optional[EventLog] = None
+
+        # events are sampled if the module supports it and --sample is given,
+        # reporters scale their metrics back to estimates
+        self.samplable = samplable
+        self.sampling: Optional[Sampling] = None
+
+        # prepare the target with the options of enable, before breakpoints
+        # are set
+        self.enablers: List[Callable[[SBTarget, Namespace], None]] = []
+
+        # collect events still held by the target before report or dump
+        self.flushers: List[Callable[[SBTarget], None]] = []
+
+        # analyses fed with the record of every event as it arrives, in all
+        # of the modes
+        self.recorders: List[Callable[[EventRecord], None]] = []
+
+        # reset the analyses and the state of the hooks along with the events
+        self.clearers: List[Callable[[], None]] = []
+
+        # breakpoint of each return address caught by on_return
+        self.return_breakpoints: Dict[int, int] = {}
 
     def on_load(self, debugger: SBDebugger):
         self.breakpoints.update(debugger)
@@ -42,14 +127,21 @@ class TracingModule:
 
     def breakpoint_name(self, name: str):
         def aux(callback: Callable[[SBFrame, SBBreakpointLocation, Any, Any], None]):
-            self.breakpoints.br_name(name)
+            self.breakpoints.br_name(name, callback)
             return callback
 
         return aux
 
     def breakpoint_regex(self, regex: str):
         def aux(callback: Callable[[SBFrame, SBBreakpointLocation, Any, Any], None]):
-            self.breakpoints.br_regex(regex)
+            self.breakpoints.br_regex(regex, callback)
+            return callback
+
+        return aux
+
+    def breakpoint_rustregex(self, regex: str):
+        def aux(callback: Callable[[SBFrame, SBBreakpointLocation, Any, Any], None]):
+            self.breakpoints.br_rustregex(regex, callback)
             return callback
 
         return aux
@@ -57,28 +149,110 @@ class TracingModule:
     def register_report_fn(self, reporter):
         self.reporter = reporter
 
-    def enable(self, target: SBTarget):
-        result = self.breakpoints.set(target)
-        if result == BreakpointManager.DUPLICATE_TARGET:
+    def register_enable_fn(self, enabler: Callable[[SBTarget, Namespace], None]):
+        self.enablers.append(enabler)
+        return enabler
+
+    def register_flush_fn(self, flusher: Callable[[SBTarget], None]):
+        self.flushers.append(flusher)
+        return flusher
+
+    def register_record_fn(self, recorder: Callable[[EventRecord], None]):
+        self.recorders.append(recorder)
+        return recorder
+
+    def register_clear_fn(self, clearer: Callable[[], None]):
+        self.clearers.append(clearer)
+        return clearer
+
+    def enable(self, target: SBTarget, options: Namespace):
+        # enabling again would switch the mode or the sampling of the events
+        # traced so far, before they are reported
+        if self.is_enabled(target):
             warn(f"tracing module '{self.name}' is already enabled")
-        elif result == BreakpointManager.HAS_UNRESOLVED:
+            return
+        # frames cached by an earlier run are not live anymore, and its events
+        # are not mixed into the reports of this one
+        clear_unwind_caches()
+        self.clear()
+        self.aggregate = options.aggregate
+        self.sampling = None
+        if options.sample is not None:
+            if self.samplable:
+                # own state, the byte countdown is not shared with other modules
+                sample: Sampling = options.sample
+                self.sampling = Sampling(sample.period, sample.by_bytes)
+                info(f"tracing module '{self.name}' samples events {self.sampling}")
+            else:
+                warn(f"tracing module '{self.name}' does not sample events, ignore it")
+        for enabler in self.enablers:
+            enabler(target, options)
+        if options.log is not None and not self.aggregate and self.log is None:
+            self.log = self.create_log(self.mix_output_name(options.log, "log"))
+            info(f"tracing module '{self.name}' logs events to '{self.log.path}'")
+        result = self.breakpoints.set(target)
+        if result == BreakpointManager.HAS_UNRESOLVED:
             warn(f"tracing module '{self.name}' has unresolved breakpoints")
             warn(f"it may not produce desired result")
         else:
             info(f"tracing module '{self.name}' is enabled")
 
     def clear(self):
+        # stack ids are shared by all modules, the stack table is kept
         self.events.clear()
+        self.aggregates.clear()
+        self.return_breakpoints.clear()
+        for clearer in self.clearers:
+            clearer()
 
     def disable(self, target: SBTarget):
         if not self.breakpoints.unset(target):
             warn(f"tracing module '{self.name}' is not enabled")
         else:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
             info(f"tracing module '{self.name}' is disabled")
 
     def report(self, target: SBTarget, output_postfix: Optional[str]):
         if self.is_enabled(target):
+            for flusher in self.flushers:
+                flusher(target)
+            self.symbolizer = Symbolizer(target)
             self.reporter(output_postfix)
+            save_demangle_caches()
+
+    def dump(self, target: SBTarget, output_postfix: Optional[str]):
+        # write events and the symbols of their stacks, so that the report
+        # could be generated by rsprof.report outside of lldb
+        if not self.is_enabled(target):
+            return
+        if self.aggregate:
+            warn(f"tracing module '{self.name}' aggregates events, nothing to dump")
+            return
+
+        for flusher in self.flushers:
+            flusher(target)
+        if self.log is None:
+            log = self.create_log(self.mix_output_name(output_postfix, "log"))
+            for record in self.records():
+                log.append(record, STACKS)
+            log.close()
+        else:
+            log = self.log
+            log.flush()
+
+        symbolizer = Symbolizer(target)
+        write_symbols(
+            log.path,
+            {
+                pc: symbolizer.symbolize_address(pc)
+                for pcs in STACKS.elemen_table
+                for pc in pcs
+            },
+        )
+        save_demangle_caches()
+        info(f"tracing module '{self.name}' dumped events to '{log.path}'")
 
     def is_enabled(self, target: SBTarget):
         for reg in self.breakpoints.reg_brs:
@@ -86,17 +260,88 @@ class TracingModule:
                 return True
         return False
 
-    def append_event(self, event):
-        self.events.append(event)
+    def create_log(self, path: str) -> EventLog:
+        log = EventLog(path)
+        write_sampling(path, None if self.sampling is None else str(self.sampling))
+        return log
+
+    def on_return(self, frame: SBFrame, continuation: Callable[[SBFrame], None]):
+        # call continuation with the frame of the caller once the function of
+        # frame returned, by stopping at the return address of the call.
+        # Returns False if the return could not be caught
+        thread: SBThread = frame.GetThread()
+        target: SBTarget = thread.GetProcess().GetTarget()
+        caller: SBFrame = frame.get_parent_frame()
+        if not caller.IsValid():
+            return False
+        return_address = caller.GetPC()
+        bp_id = self.return_breakpoints.get(return_address)
+        if bp_id is None or not target.FindBreakpointByID(bp_id).IsValid():
+            bp_id = self.breakpoints.br_address(
+                target, return_address, function_return
+            )
+        if bp_id is None:
+            return False
+        self.return_breakpoints[return_address] = bp_id
+        _returns[(thread.GetThreadID(), frame.GetCFA())] = continuation
+        return True
 
-    def mix_output_name(self, output_postfix: Optional[str]):
+    def sampled(self, loc: SBBreakpointLocation, size: int) -> bool:
+        # whether the event of a breakpoint hit, of size bytes, is traced: in
+        # event mode the breakpoint ignores the events skipped before the next
+        # sample itself, which stop the process but never run python
+        if self.sampling is None:
+            return True
+        if self.sampling.by_bytes:
+            return self.sampling.sample(size)
+        loc.GetBreakpoint().SetIgnoreCount(self.sampling.skip())
+        return True
+
+    def sample(self, size: int) -> bool:
+        # same as sampled, for events decided in python
+        return self.sampling is None or self.sampling.sample(size)
+
+    def append_event(self, event: "TracingEvent"):
+        record = None
+        if len(self.recorders) != 0:
+            record = event.to_record()
+            for recorder in self.recorders:
+                recorder(record)
+
+        if self.aggregate:
+            key = (type(event), event.stack)
+            accumulator = self.aggregates.get(key)
+            if accumulator is None:
+                accumulator = Accumulator()
+                self.aggregates[key] = accumulator
+            accumulator.fold(event.value())
+        elif self.log is not None:
+            self.log.append(event.to_record() if record is None else record, STACKS)
+        else:
+            self.events.append(event.to_record() if record is None else record)
+
+    def record_columns(self) -> Iterator[Columns]:
+        # chunks of records as columns, for vectorised aggregation
+        if self.log is not None:
+            self.log.flush()
+            return read_record_columns(self.log.path)
+        return self.events.chunks()
+
+    def records(self) -> Iterator[EventRecord]:
+        # events of the log are streamed from disk, and never all loaded
+        if self.log is not None:
+            self.log.flush()
+            return read_records(self.log.path)
+        return iter(self.events)
+
+    def mix_output_name(self, output_postfix: Optional[str], extension: str = "prof"):
         if output_postfix is None:
-            return f"{self.name}.prof"
+            return f"{self.name}.{extension}"
         else:
-            return f"{output_postfix}.{self.name}.prof"
+            return f"{output_postfix}.{self.name}.{extension}"
 
 
-REGISTED_MODULES = {"memory", "mutex", "memtrace"}
+REGISTED_MODULES = {"memory", "mutex", "memtrace", "cpu"}
 
 
 def load_tracing_modules(debugger: SBDebugger, modules: List[str]):
@@ -113,6 +358,20 @@ def load_tracing_modules(debugger: SBDebugger, modules: List[str]):
     )
 
 
-class TracingEvent:
-    def __init__(self, stacktrace: StackTrace) -> None:
-        self.stacktrace = stacktrace
+class TracingEvent(ABC):
+    __slots__ = ("thread_id", "stack", "timestamp")
+
+    def __init__(self, thread_id: int, stack: int) -> None:
+        self.thread_id = thread_id
+        # id of the call stack in traceutil.STACKS
+        self.stack = stack
+        self.timestamp = time.monotonic_ns()
+
+    def value(self) -> int:
+        # quantity folded into the accumulators in aggregate mode
+        return 0
+
+    @abstractmethod
+    def to_record(self) -> EventRecord:
+        # fixed-size form of the event, for the event log
+        ...
@@ -0,0 +1,132 @@
+from argparse import Namespace
+from typing import Dict, Optional, Tuple
+from rsprof.eventlog import CPU_SAMPLE, EventRecord
+from rsprof.lldbutil import set_launch_environment
+from rsprof.logutil import info, warn
+from rsprof.proto import Event, ProfileBuilder
+from rsprof.report import CPU_METRICS, report_samples
+from rsprof.traceutil import stack_from_sbframe
+from rsprof.tracing import TracingEvent, TracingModule
+
+from lldb import (
+    SBFrame,
+    SBBreakpointLocation,
+    SBProcess,
+    SBTarget,
+    SBThread,
+)
+
+
+MODULE = TracingModule("cpu")
+
+# the sampler thread of rsprof-stub reads its frequency from the environment
+CPU_HZ_VAR = "RSPROF_CPU_HZ"
+# samples per second unless --frequency is given
+DEFAULT_FREQUENCY = 99
+
+
+class CpuSample(TracingEvent):
+    __slots__ = ("cpu_time",)
+
+    def __init__(self, thread_id: int, stack: int, cpu_time: int) -> None:
+        super().__init__(thread_id, stack)
+        self.cpu_time = cpu_time
+
+    def value(self) -> int:
+        return self.cpu_time
+
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            CPU_SAMPLE,
+            self.thread_id,
+            self.cpu_time,
+            0,
+            0,
+            0,
+            self.timestamp,
+            self.stack,
+        )
+
+
+@MODULE.register_enable_fn
+def set_frequency(target: SBTarget, options: Namespace):
+    frequency = options.frequency
+    if target.GetProcess().IsValid():
+        # a running process keeps the frequency its sampler started with
+        if frequency is not None:
+            warn("frequency of cpu only applies to processes launched after enable")
+        return
+    if frequency is None:
+        frequency = DEFAULT_FREQUENCY
+    if frequency <= 0:
+        warn(f"ignore sampling frequency {frequency}")
+        # the sampler thread is not started without the variable
+        set_launch_environment(target, CPU_HZ_VAR, None)
+        return
+    set_launch_environment(target, CPU_HZ_VAR, str(frequency))
+    info(f"threads are sampled {frequency} times per second")
+
+
+# cpu time of each thread at its previous sample, keyed by process and thread
+_cpu_times: Dict[Tuple[int, int], int] = {}
+MODULE.register_clear_fn(_cpu_times.clear)
+
+
+def _cpu_time(pid: int, tid: int) -> Optional[int]:
+    # nanoseconds spent on a cpu, only known when the debugger runs on the
+    # same linux host as the process
+    try:
+        with open(f"/proc/{pid}/task/{tid}/schedstat", "r") as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@MODULE.breakpoint_sysname("__rsprof_cpu_sample")
+def rsprof_cpu_sample(
+    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
+):
+    # all threads are stopped together with the sampler, sample the others
+    sampler: SBThread = frame.GetThread()
+    process: SBProcess = sampler.GetProcess()
+    pid = process.GetProcessID()
+    for ti in range(0, process.GetNumThreads()):
+        thread: SBThread = process.GetThreadAtIndex(ti)
+        tid = thread.GetThreadID()
+        top: SBFrame = thread.GetFrameAtIndex(0)
+        if tid == sampler.GetThreadID() or not top.IsValid():
+            continue
+
+        # the time used since the previous sample, threads seen for the first
+        # time only start to count
+        cpu_time = _cpu_time(pid, tid)
+        previous = _cpu_times.get((pid, tid))
+        if cpu_time is not None:
+            _cpu_times[(pid, tid)] = cpu_time
+        if cpu_time is None or previous is None:
+            cpu_time = 0
+        else:
+            cpu_time = max(0, cpu_time - previous)
+
+        thread_id, stack = stack_from_sbframe(top)
+        MODULE.append_event(CpuSample(thread_id, stack, cpu_time))
+
+
+@MODULE.register_report_fn
+def report(output_postfix: Optional[str]):
+    if MODULE.aggregate:
+        profile_builder = ProfileBuilder(*CPU_METRICS)
+        for (_, stack_id), accumulator in MODULE.aggregates.items():
+            profile_builder.add_event(
+                Event(
+                    MODULE.symbolizer.symbolize_stack(stack_id),
+                    [accumulator.count, accumulator.total],
+                )
+            )
+        profile_builder.write_file(MODULE.mix_output_name(output_postfix))
+    else:
+        report_samples(
+            MODULE.record_columns(),
+            MODULE.symbolizer.symbolize_stack,
+            MODULE.mix_output_name(output_postfix),
+        )
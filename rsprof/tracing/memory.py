@@ -1,109 +1,251 @@
-from typing import Optional
+from typing import Optional, Union
+from rsprof.eventlog import ALLOC, DEALLOC, REALLOC, EventRecord
+from rsprof.heaputil import HeapTimeline, Lifetimes, LiveHeap
 from rsprof.proto import Event, ProfileBuilder
+from rsprof.samplingutil import scale_metrics
+from rsprof.report import (
+    ALLOCATION_KINDS,
+    LIFETIME_METRICS,
+    StackScales,
+    add_lifetimes,
+    build_live_heap,
+    report_allocations,
+    write_timeline,
+)
 from rsprof.tracing import TracingEvent, TracingModule
 from lldb import (
     SBFrame,
     SBBreakpointLocation,
 )
-from rsprof.traceutil import (
-    stacktrace_from_sbframe,
-    StackTrace,
-)
-from rsprof.lldbutil import get_function_parameter
+from rsprof.traceutil import stack_from_sbframe
+from rsprof.lldbutil import get_function_parameter, get_function_return
+
+
+MODULE = TracingModule("memory", samplable=True)
 
+# blocks still allocated, the live bytes over time and the lifetimes of
+# freed blocks, fed with every event
+LIVE_HEAP = LiveHeap()
+TIMELINE = HeapTimeline()
+LIFETIMES = Lifetimes()
+MODULE.register_clear_fn(LIVE_HEAP.clear)
+MODULE.register_clear_fn(TIMELINE.clear)
+MODULE.register_clear_fn(LIFETIMES.clear)
 
-MODULE = TracingModule("memory")
+
+@MODULE.register_record_fn
+def track_heap(record: EventRecord):
+    LIVE_HEAP.update(record)
+    TIMELINE.update(record, LIVE_HEAP.live_bytes)
+    LIFETIMES.update(record)
 
 
 class MemoryEvent(TracingEvent):
-    def __init__(self, stacktrace: StackTrace) -> None:
-        super().__init__(stacktrace)
+    __slots__ = ()
+
+    def __init__(self, thread_id: int, stack: int) -> None:
+        super().__init__(thread_id, stack)
+
+    def value(self) -> int:
+        return self.size
 
 
 class AllocEvent(MemoryEvent):
-    def __init__(self, stacktrace: StackTrace, size: int, align: int) -> None:
-        super().__init__(stacktrace)
+    __slots__ = ("size", "align", "addr")
+
+    def __init__(self, thread_id: int, stack: int, size: int, align: int) -> None:
+        super().__init__(thread_id, stack)
         self.size = size
         self.align = align
+        # returned address, known once the allocation function returned
+        self.addr = 0
+
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            ALLOC,
+            self.thread_id,
+            self.size,
+            self.align,
+            self.addr,
+            0,
+            self.timestamp,
+            self.stack,
+        )
 
 
 class ReallocEvent(MemoryEvent):
+    __slots__ = ("old_addr", "old_size", "size", "align", "addr")
+
     def __init__(
         self,
-        stacktrace: StackTrace,
+        thread_id: int,
+        stack: int,
         old_addr: int,
         old_size: int,
         align: int,
         new_size: int,
     ) -> None:
-        super().__init__(stacktrace)
+        super().__init__(thread_id, stack)
         self.old_addr = old_addr
         self.old_size = old_size
         self.size = new_size
         self.align = align
+        # returned address, known once the allocation function returned
+        self.addr = 0
+
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            REALLOC,
+            self.thread_id,
+            self.size,
+            self.align,
+            self.addr,
+            self.old_addr,
+            self.timestamp,
+            self.stack,
+        )
 
 
 class DeallocEvent(MemoryEvent):
+    __slots__ = ("addr", "size", "align")
+
     def __init__(
-        self, stacktrace: StackTrace, addr: int, size: int, align: int
+        self, thread_id: int, stack: int, addr: int, size: int, align: int
     ) -> None:
-        super().__init__(stacktrace)
+        super().__init__(thread_id, stack)
         self.addr = addr
         self.size = size
         self.align = align
 
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            DEALLOC,
+            self.thread_id,
+            self.size,
+            self.align,
+            self.addr,
+            0,
+            self.timestamp,
+            self.stack,
+        )
+
+
+def _append_on_return(frame: SBFrame, event: Union[AllocEvent, ReallocEvent]):
+    # the address of the block is only known when the function returns, so
+    # the event is finished at the return address of the call
+    def returned(caller: SBFrame):
+        addr = get_function_return(caller)
+        event.addr = 0 if addr is None else addr
+        MODULE.append_event(event)
+
+    if not MODULE.on_return(frame, returned):
+        # not able to catch the return, keep the event without its address
+        MODULE.append_event(event)
+
 
 @MODULE.breakpoint_sysname("__rust_alloc")
 def rust_alloc(frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict):
-    stacktrace = stacktrace_from_sbframe(frame)
-
     size, align = get_function_parameter(frame, ("u", "u"))
+    if not MODULE.sampled(loc, size):
+        return
+
+    thread_id, stack = stack_from_sbframe(frame)
 
-    MODULE.events.append(AllocEvent(stacktrace, size, align))
+    _append_on_return(frame, AllocEvent(thread_id, stack, size, align))
 
 
 @MODULE.breakpoint_sysname("__rust_alloc_zeroed")
 def rust_alloc_zeroed(
     frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
 ):
-    stacktrace = stacktrace_from_sbframe(frame)
-
     size, align = get_function_parameter(frame, ("u", "u"))
+    if not MODULE.sampled(loc, size):
+        return
+
+    thread_id, stack = stack_from_sbframe(frame)
 
-    MODULE.events.append(AllocEvent(stacktrace, size, align))
+    _append_on_return(frame, AllocEvent(thread_id, stack, size, align))
 
 
 @MODULE.breakpoint_sysname("__rust_realloc")
 def rust_realloc(frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict):
-    stacktrace = stacktrace_from_sbframe(frame)
-
     old_addr, old_size, align, new_size = get_function_parameter(
         frame, ("u", "u", "u", "u")
     )
 
-    MODULE.events.append(ReallocEvent(stacktrace, old_addr, old_size, align, new_size))
+    # reallocations always stop, a sampled block may be moved by any of them
+    if not MODULE.sample(new_size):
+        if old_addr in LIVE_HEAP.blocks:
+            thread_id, stack = stack_from_sbframe(frame)
+            MODULE.append_event(
+                DeallocEvent(thread_id, stack, old_addr, old_size, align)
+            )
+        return
+
+    thread_id, stack = stack_from_sbframe(frame)
+
+    _append_on_return(
+        frame, ReallocEvent(thread_id, stack, old_addr, old_size, align, new_size)
+    )
 
 
 @MODULE.breakpoint_sysname("__rust_dealloc")
 def rust_dealloc(frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict):
-    stacktrace = stacktrace_from_sbframe(frame)
-
     addr, size, align = get_function_parameter(frame, ("u", "u", "u"))
+    # only the deallocations of sampled blocks are kept
+    if MODULE.sampling is not None and addr not in LIVE_HEAP.blocks:
+        return
 
-    MODULE.append_event(DeallocEvent(stacktrace, addr, size, align))
+    thread_id, stack = stack_from_sbframe(frame)
+
+    MODULE.append_event(DeallocEvent(thread_id, stack, addr, size, align))
 
 
 @MODULE.register_report_fn
 def report(output_postfix: Optional[str]):
-    profile_builder = ProfileBuilder(
-        ("bytes", "allocation size"), ("bytes", "allocation align")
+    scales = None
+    if MODULE.sampling is not None:
+        scales = StackScales(MODULE.sampling, LIVE_HEAP.allocated)
+    if MODULE.aggregate:
+        profile_builder = ProfileBuilder(
+            ("bytes", "allocation size"),
+            ("count", "allocation count"),
+            ("bytes", "max allocation size", max),
+            *LIFETIME_METRICS,
+        )
+        for (kind, stack_id), accumulator in MODULE.aggregates.items():
+            if issubclass(kind, (AllocEvent, ReallocEvent)):
+                metric = [accumulator.total, accumulator.count, accumulator.peak]
+                if scales is not None:
+                    factor = scales(stack_id, accumulator.count, accumulator.total)
+                    metric = scale_metrics(metric, factor, (2,))
+                profile_builder.add_event(
+                    Event(
+                        MODULE.symbolizer.symbolize_stack(stack_id),
+                        metric + [0] * len(LIFETIME_METRICS),
+                    )
+                )
+        add_lifetimes(
+            profile_builder, LIFETIMES, MODULE.symbolizer.symbolize_stack, scales
+        )
+        profile_builder.write_file(MODULE.mix_output_name(output_postfix))
+    else:
+        report_allocations(
+            MODULE.record_columns(),
+            ALLOCATION_KINDS["memory"],
+            MODULE.symbolizer.symbolize_stack,
+            MODULE.mix_output_name(output_postfix),
+            LIFETIMES,
+            scales,
+        )
+
+    build_live_heap(LIVE_HEAP, MODULE.symbolizer.symbolize_stack, scales).write_file(
+        MODULE.mix_output_name(output_postfix, "live.prof")
+    )
+    write_timeline(
+        TIMELINE,
+        MODULE.symbolizer.symbolize_stack,
+        MODULE.mix_output_name(output_postfix, "timeline.json"),
+        1.0 if scales is None else scales.total(),
     )
-    for event in MODULE.events:
-        event.stacktrace.resolve()
-        if isinstance(event, AllocEvent) or isinstance(event, ReallocEvent):
-            allocation_size = event.size
-            profile_builder.add_event(
-                Event(event.stacktrace, [allocation_size, event.align])
-            )
-    profile_builder.write_file(MODULE.mix_output_name(output_postfix))
  
\ No newline at end of file
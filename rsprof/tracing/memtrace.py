@@ -1,69 +1,428 @@
-from typing import Optional
-from rsprof.lldbutil import get_function_parameter
+from argparse import Namespace
+import heapq
+from itertools import count
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from rsprof.eventlog import ALLOC, DEALLOC, EventRecord
+from rsprof.lldbutil import (
+    get_function_parameter,
+    read_memory_struct,
+    set_launch_environment,
+)
 from ..proto import (
     Event,
     ProfileBuilder,
 )
-from rsprof.traceutil import StackTrace, stacktrace_from_sbframe
+from rsprof.heaputil import HeapTimeline, Lifetimes, LiveHeap
+from rsprof.report import (
+    ALLOCATION_KINDS,
+    LIFETIME_METRICS,
+    StackScales,
+    add_lifetimes,
+    build_live_heap,
+    report_allocations,
+    write_timeline,
+)
+from rsprof.logutil import warn
+from rsprof.samplingutil import scale_metrics
+from rsprof.traceutil import STACKS, stack_from_sbframe
 from rsprof.tracing import TracingEvent, TracingModule
 
-from lldb import SBFrame, SBBreakpointLocation
+from lldb import (
+    SBFrame,
+    SBBreakpointLocation,
+    SBError,
+    SBProcess,
+    SBSymbol,
+    SBSymbolContextList,
+    SBTarget,
+    SBThread,
+    eByteOrderLittle,
+)
+
+
+MODULE = TracingModule("memtrace", samplable=True)
+
+# rsprof-stub samples events itself at the rate the debugger puts there
+SAMPLE_VAR = "RSPROF_SAMPLE"
+
+# blocks still allocated, the live bytes over time and the lifetimes of
+# freed blocks, fed with every event
+LIVE_HEAP = LiveHeap()
+TIMELINE = HeapTimeline()
+LIFETIMES = Lifetimes()
+MODULE.register_clear_fn(LIVE_HEAP.clear)
+MODULE.register_clear_fn(TIMELINE.clear)
+MODULE.register_clear_fn(LIFETIMES.clear)
+
 
+@MODULE.register_record_fn
+def track_heap(record: EventRecord):
+    LIVE_HEAP.update(record)
+    TIMELINE.update(record, LIVE_HEAP.live_bytes)
+    LIFETIMES.update(record)
 
-MODULE = TracingModule("memtrace")
+
+@MODULE.register_enable_fn
+def set_sampling(target: SBTarget, options: Namespace):
+    # skipped events never stop the process, the ones reaching the hooks are
+    # all traced
+    if target.GetProcess().IsValid():
+        if MODULE.sampling is not None:
+            warn("sampling of memtrace only applies to processes launched after enable")
+            MODULE.sampling = None
+        return
+    # without --sample the variable of an earlier enable is unset
+    sampling = None if MODULE.sampling is None else f"{MODULE.sampling}"
+    set_launch_environment(target, SAMPLE_VAR, sampling)
 
 
 class MemtraceEvent(TracingEvent):
-    def __init__(self, stacktrace: StackTrace) -> None:
-        super().__init__(stacktrace)
+    __slots__ = ()
+
+    def __init__(self, thread_id: int, stack: int) -> None:
+        super().__init__(thread_id, stack)
+
+    def value(self) -> int:
+        return self.size
 
 
 class AllocationEvent(MemtraceEvent):
+    __slots__ = ("size", "align", "addr")
+
     def __init__(
-        self, stacktrace: StackTrace, size: int, align: int, addr: int
+        self, thread_id: int, stack: int, size: int, align: int, addr: int
     ) -> None:
-        super().__init__(stacktrace)
+        super().__init__(thread_id, stack)
         self.size = size
         self.align = align
         self.addr = addr
 
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            ALLOC,
+            self.thread_id,
+            self.size,
+            self.align,
+            self.addr,
+            0,
+            self.timestamp,
+            self.stack,
+        )
+
 
 class DeallocationEvent(MemtraceEvent):
+    __slots__ = ("size", "align", "addr")
+
     def __init__(
-        self, stacktrace: StackTrace, size: int, align: int, addr: int
+        self, thread_id: int, stack: int, size: int, align: int, addr: int
     ) -> None:
-        super().__init__(stacktrace)
+        super().__init__(thread_id, stack)
         self.size = size
         self.align = align
         self.addr = addr
 
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            DEALLOC,
+            self.thread_id,
+            self.size,
+            self.align,
+            self.addr,
+            0,
+            self.timestamp,
+            self.stack,
+        )
+
 
 @MODULE.breakpoint_sysname("__rsprof_memtrace_event")
 def rsprof_memtrace_event(
     frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
 ):
-    stacktrace = stacktrace_from_sbframe(frame)
+    thread_id, stack = stack_from_sbframe(frame)
 
     event_id, size, align, ptr = get_function_parameter(frame, ("u", "u", "u", "u"))
 
     if event_id == 0:
-        event = AllocationEvent(stacktrace, size, align, ptr)
+        event = AllocationEvent(thread_id, stack, size, align, ptr)
     else:
-        event = DeallocationEvent(stacktrace, size, align, ptr)
+        event = DeallocationEvent(thread_id, stack, size, align, ptr)
+
+    _append_in_order(frame.GetThread().GetProcess(), event)
+
+
+def _read_backtrace(process: SBProcess, pcs: int, depth: int) -> Tuple[int, ...]:
+    error = SBError()
+    content = process.ReadMemory(pcs, depth * 8, error)
+    if depth == 0 or not error.Success():
+        return ()
+    byte_order = "<" if process.GetByteOrder() == eByteOrderLittle else ">"
+    # return addresses point past the call instruction
+    return tuple(pc - 1 for pc in struct.unpack(f"{byte_order}{depth}Q", content))
+
+
+@MODULE.breakpoint_sysname("__rsprof_memtrace_backtrace_event")
+def rsprof_memtrace_backtrace_event(
+    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
+):
+    event_id, size, align, ptr, pcs, depth = get_function_parameter(
+        frame, ("u", "u", "u", "u", "u", "u")
+    )
+
+    thread: SBThread = frame.GetThread()
+    thread_id = thread.GetThreadID()
+    stack = STACKS.intern(_read_backtrace(thread.GetProcess(), pcs, depth))
+
+    if event_id == 0:
+        event = AllocationEvent(thread_id, stack, size, align, ptr)
+    else:
+        event = DeallocationEvent(thread_id, stack, size, align, ptr)
+
+    _append_in_order(thread.GetProcess(), event)
+
+
+# number of rings in rsprof-stub's "ring-buffer" mode
+MAX_RINGS = 256
+
+# record written by the "ring-buffer" mode of rsprof-stub:
+# event, size, align, ptr, thread (ring index), timestamp
+RING_RECORD = struct.Struct("6Q")
+# followed by depth and the backtrace with the "backtrace" feature
+RING_BACKTRACE = struct.Struct("Q")
 
-    MODULE.append_event(event)
+
+class RingLayout(NamedTuple):
+    # load addresses of the rings and of their count, and their sizes
+    rings: int
+    ring_count: int
+    ring_size: int
+    record_size: int
+
+
+# layout of the rings of each process, None if it has no rings
+_ring_layouts: Dict[int, Optional[RingLayout]] = {}
+
+# events read from the rings, and the ones of the hooks while rings are in
+# use, wait here until no event older than them could still be buffered in a
+# ring, so that the heap analyses see every event in the order of time: a
+# ring is only read when it fills up, its records may be older than the
+# events of the other threads read before them
+_ordered: List[Tuple[int, int, "MemtraceEvent"]] = []
+MODULE.register_clear_fn(_ordered.clear)
+# ties of timestamps are kept in the order events are read
+_sequence = count()
+
+
+def _symbol_load_address(target: SBTarget, name: str) -> Optional[int]:
+    contexts: SBSymbolContextList = target.FindSymbols(name)
+    if contexts.GetSize() == 0:
+        return None
+    symbol: SBSymbol = contexts.GetContextAtIndex(0).GetSymbol()
+    return symbol.GetStartAddress().GetLoadAddress(target)
+
+
+def _ring_layout(process: SBProcess) -> Optional[RingLayout]:
+    key = process.GetUniqueID()
+    if key in _ring_layouts:
+        return _ring_layouts[key]
+    target: SBTarget = process.GetTarget()
+    layout = None
+    rings = _symbol_load_address(target, "__rsprof_memtrace_rings")
+    ring_count = _symbol_load_address(target, "__rsprof_memtrace_ring_count")
+    ring_capacity = _symbol_load_address(target, "__rsprof_memtrace_ring_capacity")
+    record_size = _symbol_load_address(target, "__rsprof_memtrace_record_size")
+    if rings is not None and ring_count is not None and ring_capacity is not None:
+        usize = "Q" if process.GetAddressByteSize() == 8 else "I"
+        capacity = read_memory_struct(process, ring_capacity, usize)
+        record = (RING_RECORD.size,)
+        if record_size is not None:
+            record = read_memory_struct(process, record_size, usize)
+        if capacity is None or record is None:
+            # not readable yet, e.g. before the process is launched
+            return None
+        # layout of rsprof-stub's Ring: the length, then the records
+        ring_size = process.GetAddressByteSize() + capacity[0] * record[0]
+        layout = RingLayout(rings, ring_count, ring_size, record[0])
+    _ring_layouts[key] = layout
+    return layout
+
+
+def _rings_in_use(process: SBProcess, layout: RingLayout) -> int:
+    usize = "Q" if process.GetAddressByteSize() == 8 else "I"
+    ring_count = read_memory_struct(process, layout.ring_count, usize)
+    return 0 if ring_count is None else min(ring_count[0], MAX_RINGS)
+
+
+def _oldest_buffered(
+    process: SBProcess, layout: RingLayout, skipped: Optional[int] = None
+) -> Optional[int]:
+    # timestamp of the oldest record still buffered in the rings but the
+    # skipped one, the first record of a ring is its oldest
+    usize_size = process.GetAddressByteSize()
+    usize = "Q" if usize_size == 8 else "I"
+    oldest = None
+    for index in range(0, _rings_in_use(process, layout)):
+        if index == skipped:
+            continue
+        ring = layout.rings + index * layout.ring_size
+        # the stub publishes the length once the records below it are written,
+        # a record at or above it may be half written: the length is read
+        # first and only then the record below it
+        length = read_memory_struct(process, ring, usize)
+        if length is None or length[0] == 0:
+            continue
+        # timestamp is the last field of RING_RECORD
+        first = read_memory_struct(
+            process, ring + usize_size + RING_RECORD.size - 8, "Q"
+        )
+        if first is not None and (oldest is None or first[0] < oldest):
+            oldest = first[0]
+    return oldest
+
+
+def _release(watermark: Optional[int]):
+    # events up to watermark, or all of them
+    while len(_ordered) != 0 and (watermark is None or _ordered[0][0] <= watermark):
+        MODULE.append_event(heapq.heappop(_ordered)[2])
+
+
+def _append_in_order(process: SBProcess, event: "MemtraceEvent"):
+    layout = _ring_layout(process)
+    if layout is None:
+        # events of processes without rings arrive in order
+        MODULE.append_event(event)
+        return
+    heapq.heappush(_ordered, (event.timestamp, next(_sequence), event))
+    oldest = _oldest_buffered(process, layout)
+    _release(event.timestamp if oldest is None else min(oldest, event.timestamp))
+
+
+def _append_ring_records(
+    process: SBProcess, records: int, count: int, record_size: int
+) -> Optional[int]:
+    # events are pushed for _release, returns the timestamp of the last one
+    error = SBError()
+    content = process.ReadMemory(records, count * record_size, error)
+    if not error.Success():
+        return None
+
+    byte_order = "<" if process.GetByteOrder() == eByteOrderLittle else ">"
+    record_format = struct.Struct(byte_order + RING_RECORD.format)
+    depth_format = struct.Struct(byte_order + RING_BACKTRACE.format)
+    has_backtrace = record_size > RING_RECORD.size
+    last = None
+    for offset in range(0, count * record_size, record_size):
+        event_id, size, align, ptr, thread, timestamp = record_format.unpack_from(
+            content, offset
+        )
+        # the call site is only known if the stub captured a backtrace
+        pcs: Tuple[int, ...] = ()
+        if has_backtrace:
+            offset += RING_RECORD.size
+            (depth,) = depth_format.unpack_from(content, offset)
+            pcs = tuple(
+                pc - 1
+                for pc in struct.unpack_from(
+                    f"{byte_order}{depth}Q", content, offset + depth_format.size
+                )
+            )
+        stack = STACKS.intern(pcs)
+        if event_id == 0:
+            event = AllocationEvent(thread, stack, size, align, ptr)
+        else:
+            event = DeallocationEvent(thread, stack, size, align, ptr)
+        # nanoseconds of the monotonic clock, taken by the stub
+        event.timestamp = timestamp
+        heapq.heappush(_ordered, (timestamp, next(_sequence), event))
+        last = timestamp
+    return last
+
+
+@MODULE.breakpoint_sysname("__rsprof_memtrace_flush")
+def rsprof_memtrace_flush(
+    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
+):
+    records, count, record_size = get_function_parameter(frame, ("u", "u", "u"))
+    process: SBProcess = frame.GetThread().GetProcess()
+    last = _append_ring_records(process, records, count, record_size)
+    layout = _ring_layout(process)
+    if last is None or layout is None:
+        return
+    # the flushed ring is only emptied once the hook returns, and the next
+    # records of every empty ring are newer than the last flushed one
+    ring = (records - process.GetAddressByteSize() - layout.rings) // layout.ring_size
+    oldest = _oldest_buffered(process, layout, ring)
+    _release(last if oldest is None else min(oldest, last))
+
+
+@MODULE.register_flush_fn
+def drain_rings(target: SBTarget):
+    # records still buffered while the process is stopped, e.g. at a crash,
+    # then every event is released as the rings are empty
+    process: SBProcess = target.GetProcess()
+    layout = None
+    if process.IsValid() and process.is_stopped:
+        layout = _ring_layout(process)
+    if layout is not None:
+        usize_size = process.GetAddressByteSize()
+        usize = "Q" if usize_size == 8 else "I"
+        for index in range(0, _rings_in_use(process, layout)):
+            ring = layout.rings + index * layout.ring_size
+            length = read_memory_struct(process, ring, usize)
+            if length is None or length[0] == 0:
+                continue
+            _append_ring_records(
+                process, ring + usize_size, length[0], layout.record_size
+            )
+            # consumed, do not report them again
+            process.WriteMemory(ring, bytes(usize_size), SBError())
+    _release(None)
 
 
 @MODULE.register_report_fn
 def report(output_postfix: Optional[str]):
-    profile_builder = ProfileBuilder(
-        ("bytes", "allocation size"), ("bytes", "allocation align")
+    scales = None
+    if MODULE.sampling is not None:
+        scales = StackScales(MODULE.sampling, LIVE_HEAP.allocated)
+    if MODULE.aggregate:
+        profile_builder = ProfileBuilder(
+            ("bytes", "allocation size"),
+            ("count", "allocation count"),
+            ("bytes", "max allocation size", max),
+            *LIFETIME_METRICS,
+        )
+        for (kind, stack_id), accumulator in MODULE.aggregates.items():
+            if issubclass(kind, AllocationEvent):
+                metric = [accumulator.total, accumulator.count, accumulator.peak]
+                if scales is not None:
+                    factor = scales(stack_id, accumulator.count, accumulator.total)
+                    metric = scale_metrics(metric, factor, (2,))
+                profile_builder.add_event(
+                    Event(
+                        MODULE.symbolizer.symbolize_stack(stack_id),
+                        metric + [0] * len(LIFETIME_METRICS),
+                    )
+                )
+        add_lifetimes(
+            profile_builder, LIFETIMES, MODULE.symbolizer.symbolize_stack, scales
+        )
+        profile_builder.write_file(MODULE.mix_output_name(output_postfix))
+    else:
+        report_allocations(
+            MODULE.record_columns(),
+            ALLOCATION_KINDS["memtrace"],
+            MODULE.symbolizer.symbolize_stack,
+            MODULE.mix_output_name(output_postfix),
+            LIFETIMES,
+            scales,
+        )
+
+    build_live_heap(LIVE_HEAP, MODULE.symbolizer.symbolize_stack, scales).write_file(
+        MODULE.mix_output_name(output_postfix, "live.prof")
+    )
+    write_timeline(
+        TIMELINE,
+        MODULE.symbolizer.symbolize_stack,
+        MODULE.mix_output_name(output_postfix, "timeline.json"),
+        1.0 if scales is None else scales.total(),
     )
-    for event in MODULE.events:
-        event.stacktrace.resolve()
-        if isinstance(event, AllocationEvent):
-            allocation_size = event.size
-            profile_builder.add_event(
-                Event(event.stacktrace, [allocation_size, event.align])
-            )
-    profile_builder.write_file(MODULE.mix_output_name(output_postfix))
@@ -1,43 +1,176 @@
 import struct
 from typing import Optional
+from rsprof.eventlog import (
+    LOCK_ACQUIRE,
+    LOCK_ATTEMPT,
+    LOCK_RELEASE,
+    LOCK_WAIT,
+    EventRecord,
+)
 from rsprof.lldbutil import get_function_parameter
-from ..proto import (
-    Event,
-    ProfileBuilder,
+from rsprof.lockutil import LockContention, LockOrder
+from rsprof.report import (
+    CONTENTION_TOP_MUTEXES,
+    build_contention,
+    contention_summary,
+    lock_cycle_summary,
+    write_lock_cycles,
 )
-from rsprof.traceutil import stacktrace_from_sbframe
-from rsprof.tracing import TracingModule
+from rsprof.logutil import info, warn
+from rsprof.traceutil import stack_from_sbframe
+from rsprof.tracing import TracingEvent, TracingModule
 
-from lldb import SBFrame, SBBreakpointLocation, SBError, SBProcess
+from lldb import (
+    SBFrame,
+    SBBreakpointLocation,
+    SBError,
+    SBProcess,
+)
 
 
 MODULE = TracingModule("mutex")
 
+# wait and hold times of every mutex and acquiring call site, and the order
+# in which threads nest mutexes, fed with every event
+CONTENTION = LockContention()
+LOCK_ORDER = LockOrder()
+MODULE.register_record_fn(CONTENTION.update)
+MODULE.register_record_fn(LOCK_ORDER.update)
+MODULE.register_clear_fn(CONTENTION.clear)
+MODULE.register_clear_fn(LOCK_ORDER.clear)
+
+
+class LockEvent(TracingEvent):
+    __slots__ = ("kind", "mutex", "since")
+
+    def __init__(self, thread_id: int, stack: int, kind: int, mutex: int) -> None:
+        super().__init__(thread_id, stack)
+        # one of eventlog.LOCK_*
+        self.kind = kind
+        self.mutex = mutex
+        # when an acquisition started waiting, if the target measured it
+        self.since = 0
+
+    def to_record(self) -> EventRecord:
+        return EventRecord(
+            self.kind,
+            self.thread_id,
+            0,
+            0,
+            self.mutex,
+            self.since,
+            self.timestamp,
+            self.stack,
+        )
 
-@MODULE.breakpoint_srcloc("sync/mutex.rs", 501)
-def mutexguard_create(
-    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
-):
-    stacktrace = stacktrace_from_sbframe(frame)
-    (mutex_addr,) = get_function_parameter(frame, ("u"))
 
-    print(mutex_addr, "is acquired by thread id", stacktrace.thread_id)
+# hooks are resolved by the demangled names of functions, which survive
+# toolchain upgrades unlike lines of the sources of std, and the modules in
+# between the crate and the type are left open as they move across versions.
+# The generic functions of std::sync::Mutex and lock_api::Mutex (of
+# parking_lot) are only found in unoptimized code, RsprofMutex of rsprof-stub
+# is found in any build.
+_HASH = r"(?:::h[0-9a-f]{16})?$"
+
+
+def _method(type_regex: str, method: str) -> str:
+    # inherent methods are demangled as `Type::method` from legacy mangling
+    # and as `<Type>::method` from v0 mangling
+    return rf"^(?:{type_regex}|<{type_regex}>)::{method}{_HASH}"
+
+
+def _drop(type_regex: str) -> str:
+    return rf"^<{type_regex} as core::ops::drop::Drop>::drop{_HASH}"
+
+
+def _append_lock_event(frame: SBFrame, kind: int, mutex_addr: int):
+    thread_id, stack = stack_from_sbframe(frame)
+    MODULE.append_event(LockEvent(thread_id, stack, kind, mutex_addr))
 
 
 def _inspect_mutexguard(frame: SBFrame, mutexguard_addr: int) -> int:
+    # the mutex reference is the first field of the guards of std and lock_api
     process: SBProcess = frame.GetThread().GetProcess()
     error = SBError()
     content = process.ReadMemory(mutexguard_addr, struct.calcsize("P"), error)
     return struct.unpack("P", content)[0]
 
 
-@MODULE.breakpoint_srcloc("sync/mutex.rs", 525)
+@MODULE.breakpoint_rustregex(_method(r"std::sync::(?:\w+::)*Mutex<.+>", "lock"))
+@MODULE.breakpoint_rustregex(_method(r"lock_api::(?:\w+::)*Mutex<.+>", "lock"))
+def mutex_lock(frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict):
+    thread_id, stack = stack_from_sbframe(frame)
+    (mutex_addr,) = get_function_parameter(frame, ("u"))
+
+    attempt = LockEvent(thread_id, stack, LOCK_ATTEMPT, mutex_addr)
+    MODULE.append_event(attempt)
+
+    # the mutex is acquired once the function returns, as the constructors of
+    # the guards are inlined, so the acquisition is traced at the return
+    # address of the call
+    def acquired(caller: SBFrame):
+        # acquired at the call site of the attempt
+        MODULE.append_event(LockEvent(thread_id, stack, LOCK_ACQUIRE, mutex_addr))
+
+    MODULE.on_return(frame, acquired)
+
+
+@MODULE.breakpoint_rustregex(_drop(r"std::sync::(?:\w+::)*MutexGuard<.+>"))
+@MODULE.breakpoint_rustregex(_drop(r"lock_api::(?:\w+::)*MutexGuard<.+>"))
 def mutexguard_drop(
     frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
 ):
-    stacktrace = stacktrace_from_sbframe(frame)
-
     mutex_addr = _inspect_mutexguard(
         frame, get_function_parameter(frame, ("u"))[0])
 
-    print(mutex_addr, "is dropped by thread id", stacktrace.thread_id)
+    _append_lock_event(frame, LOCK_RELEASE, mutex_addr)
+
+
+# slow paths of the raw mutexes, entered when the mutex is held by another
+# thread: the futex mutex of std, and the raw mutex of parking_lot. Both are
+# never inlined, so they are found in optimized builds as well.
+@MODULE.breakpoint_rustregex(_method(r"std::sys::(?:\w+::)*Mutex", "lock_contended"))
+@MODULE.breakpoint_rustregex(_method(r"parking_lot::raw_mutex::RawMutex", "lock_slow"))
+def mutex_wait(frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict):
+    (raw_mutex_addr,) = get_function_parameter(frame, ("u"))
+
+    _append_lock_event(frame, LOCK_WAIT, raw_mutex_addr)
+
+
+# lock events of RsprofMutex, in the order of rsprof_stub::MUTEX_*
+_STUB_EVENTS = (LOCK_ATTEMPT, LOCK_ACQUIRE, LOCK_RELEASE)
+
+
+@MODULE.breakpoint_sysname("__rsprof_mutex_event")
+def rsprof_mutex_event(
+    frame: SBFrame, loc: SBBreakpointLocation, extra_args, interal_dict
+):
+    event, mutex_addr, timestamp, since = get_function_parameter(
+        frame, ("u", "u", "u", "u")
+    )
+
+    if event < len(_STUB_EVENTS):
+        # timestamps of the target, on the clock of the debugger, leave the
+        # stops at the hooks out of the wait and hold times
+        thread_id, stack = stack_from_sbframe(frame)
+        lock_event = LockEvent(thread_id, stack, _STUB_EVENTS[event], mutex_addr)
+        lock_event.timestamp = timestamp
+        lock_event.since = since
+        MODULE.append_event(lock_event)
+
+
+@MODULE.register_report_fn
+def report(output_postfix: Optional[str]):
+    # contention is rebuilt from the records in all of the modes
+    stacktrace = MODULE.symbolizer.symbolize_stack
+    filename = MODULE.mix_output_name(output_postfix)
+    build_contention(CONTENTION, stacktrace).write_file(filename)
+    write_lock_cycles(
+        LOCK_ORDER,
+        stacktrace,
+        MODULE.mix_output_name(output_postfix, "lockorder.json"),
+    )
+    for line in contention_summary(CONTENTION, stacktrace, CONTENTION_TOP_MUTEXES):
+        info(line)
+    for line in lock_cycle_summary(LOCK_ORDER, stacktrace):
+        warn(line)